@@ -0,0 +1,153 @@
+#!/usr/bin/python3
+
+import argparse
+import os
+import sys
+
+from app.src.tag_filter import FilterError, TagFilter, find_tag
+from app.src.tag_store import TagStore
+from app.src.tag_xattr import export_xattrs, import_xattrs
+
+META_FILE = "../meta.json"  # The same metadata file as the explorer
+
+"""
+Command line interface to the tags, without Qt. Examples:
+
+    python3 cli.py tag "urgent tag" report.pdf notes/
+    python3 cli.py tag --add special report.pdf
+    python3 cli.py untag report.pdf
+    python3 cli.py list "urgent tag" --under ~/projects
+    python3 cli.py list "urgent OR special, NOT normal"
+    python3 cli.py stats
+    python3 cli.py gc
+    python3 cli.py export-json tags.json
+    python3 cli.py export-xattr --under ~/projects
+    python3 cli.py import-xattr ~/projects
+"""
+
+
+def tag(store, args):
+    color_tag = find_color_tag(store, args.tag)
+    paths = [os.path.abspath(p) for p in args.paths]
+    if args.add:
+        store.add_tag(paths, color_tag[3])
+    else:
+        store.tag_paths(paths, color_tag[3])
+
+
+def untag(store, args):
+    paths = [os.path.abspath(p) for p in args.paths]
+    if args.tag:
+        store.remove_tag(paths, find_color_tag(store, args.tag)[3])
+    else:
+        store.untag_paths(paths)
+
+
+def list_by_tag(store, args):
+    try:
+        tag_filter = TagFilter.parse(args.filter, store.color_tags)
+    except FilterError as e:
+        sys.exit(str(e))
+    root = os.path.abspath(os.path.expanduser(args.under)) if args.under else None
+    for path in store.paths_matching(tag_filter, root):
+        print(path)
+
+
+def stats(store, args):
+    for color_tag, paths, dirs in store.stats():
+        print(f"{color_tag[3]:>3}  {color_tag[0]:<20} {paths:>9} paths in {dirs} directories")
+    print(f"Tagged paths: {len(store)}")
+
+
+def collect_garbage(store, args):
+    cursor, reclaimed = store.collect_garbage()
+    while cursor is not None:
+        cursor, count = store.collect_garbage(cursor)
+        reclaimed += count
+    print(f"Removed the tags of {reclaimed} paths that don't exist")
+
+
+def export_json(store, args):
+    store.export_json(args.file)
+
+
+def import_json(store, args):
+    store.import_json(args.file)
+
+
+def export_xattr(store, args):
+    root = os.path.abspath(os.path.expanduser(args.under)) if args.under else None
+    written, failed = export_xattrs(store, root)
+    print(f"Wrote the tags of {written} paths to their extended attributes")
+    if failed:
+        print(f"{failed} paths don't exist or their filesystem doesn't support extended attributes")
+
+
+def import_xattr(store, args):
+    changed = import_xattrs(store, os.path.abspath(os.path.expanduser(args.root)))
+    print(f"Read the tags of {changed} paths from their extended attributes")
+
+
+def find_color_tag(store, key):
+    try:
+        return store.color_tag(find_tag(key, store.color_tags))
+    except FilterError as e:
+        sys.exit(str(e))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Query and change the color tags of the file explorer")
+    parser.add_argument("--meta", default=os.environ.get("COLOR_TAGS_META", META_FILE),
+                        help="Metadata file (default: %(default)s)")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    tag_parser = commands.add_parser("tag", help="Give a tag to some paths")
+    tag_parser.add_argument("tag", help="Name, beginning of the name or id of the tag")
+    tag_parser.add_argument("--add", action="store_true", help="Keep the tags that the paths already have")
+    tag_parser.add_argument("paths", nargs="+")
+    tag_parser.set_defaults(func=tag)
+
+    untag_parser = commands.add_parser("untag", help="Remove the tags of some paths")
+    untag_parser.add_argument("--tag", help="Remove only this tag, by name or id")
+    untag_parser.add_argument("paths", nargs="+")
+    untag_parser.set_defaults(func=untag)
+
+    list_parser = commands.add_parser("list", help="List the tagged paths that match a filter")
+    list_parser.add_argument("filter", help="Name or id of a tag, or tags combined with AND, OR, NOT and commas")
+    list_parser.add_argument("--under", help="Only the paths under this directory")
+    list_parser.set_defaults(func=list_by_tag)
+
+    stats_parser = commands.add_parser("stats", help="Number of tagged paths per tag")
+    stats_parser.set_defaults(func=stats)
+
+    gc_parser = commands.add_parser("gc", help="Remove the tags of the paths that don't exist")
+    gc_parser.set_defaults(func=collect_garbage)
+
+    export_parser = commands.add_parser("export-json", help="Write the tags to a JSON metadata file")
+    export_parser.add_argument("file")
+    export_parser.set_defaults(func=export_json)
+
+    import_parser = commands.add_parser("import-json",
+                                        help="Replace all the tags with the ones of a JSON metadata file")
+    import_parser.add_argument("file")
+    import_parser.set_defaults(func=import_json)
+
+    export_xattr_parser = commands.add_parser("export-xattr", help="Write the tags to extended attributes of the files")
+    export_xattr_parser.add_argument("--under", help="Only the paths under this directory")
+    export_xattr_parser.set_defaults(func=export_xattr)
+
+    import_xattr_parser = commands.add_parser("import-xattr",
+                                              help="Read the tags of the extended attributes of the files of a tree")
+    import_xattr_parser.add_argument("root")
+    import_xattr_parser.set_defaults(func=import_xattr)
+
+    args = parser.parse_args(argv)
+    store = TagStore(args.meta)
+    try:
+        args.func(store, args)
+    finally:
+        store.close()
+
+
+if __name__ == "__main__":
+    main()
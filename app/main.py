@@ -1,5 +1,6 @@
 #!/usr/bin/python3
 
+import os
 import sys
 
 from PyQt5.QtWidgets import QApplication
@@ -7,6 +8,10 @@ from PyQt5.QtWidgets import QApplication
 from app.src.file_explorer import FileExplorerApp
 
 META_FILE = "../meta.json"
+# With COLOR_TAGS_XATTR=1 the tags are also kept in extended attributes of the files
+XATTRS = os.environ.get("COLOR_TAGS_XATTR", "0") != "0"
+# Entries above which a directory is shown in the large-directory mode
+LARGE_DIRECTORY = int(os.environ.get("COLOR_TAGS_LARGE_DIRECTORY", "10000"))
 
 """
 Entry point of the application
@@ -15,7 +20,7 @@ Entry point of the application
 
 def main():
     app = QApplication(sys.argv)
-    file_explorer = FileExplorerApp(META_FILE)
+    file_explorer = FileExplorerApp(META_FILE, XATTRS, LARGE_DIRECTORY)
     file_explorer.show()
     sys.exit(app.exec_())
 
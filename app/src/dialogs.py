@@ -1,13 +1,22 @@
 import os
+import re
 
-from PyQt5.QtCore import Qt
-from PyQt5.QtGui import QPalette, QStandardItemModel, QStandardItem
-from PyQt5.QtWidgets import QDialog, QColorDialog, QStyledItemDelegate, QStyle
+from PyQt5.QtCore import Qt, QTimer, pyqtSignal
+from PyQt5.QtGui import QColor, QPalette, QStandardItemModel, QStandardItem
+from PyQt5.QtWidgets import QDialog, QColorDialog, QStyledItemDelegate, QStyle, QListWidgetItem, QMessageBox, \
+    QTableWidgetItem, QDialogButtonBox
 from PyQt5.uic import loadUi
 
+from app.src.file_operations import name_matcher
+from app.src.tag_stats import format_size
 from app.ui.edit_tags import Ui_EditTagsDialog
 
 
+def qt_color_tags(color_tags):
+    """Convert the "#rrggbb" colors of the color tags of the tag store to QColor, the way the widgets use them"""
+    return [(v[0], QColor(v[1]), QColor(v[2]), v[3]) for v in color_tags]
+
+
 class NewFileDialog(QDialog):
     def __init__(self, current_path, parent=None):
         super().__init__(parent)
@@ -39,11 +48,11 @@ class NewFolderDialog(QDialog):
 
 
 class NewColorTagDialog(QDialog):
-    def __init__(self, color_tags, parent=None):
+    def __init__(self, file_states, parent=None):
         super().__init__(parent)
         loadUi("ui/new-color-tag.ui", self)
 
-        self.color_tags = color_tags
+        self.file_states = file_states
 
         self.BaseColorButton.clicked.connect(self.base_color_picker)
         self.FontColorButton.clicked.connect(self.font_color_picker)
@@ -64,23 +73,23 @@ class NewColorTagDialog(QDialog):
 
     def create_color_tag(self):
         palette = self.exampleColors.palette()
-        self.color_tags.append((self.tagNameLineEdit.text(),
-                                palette.color(QPalette.Base),
-                                palette.color(QPalette.Text)))
+        self.file_states.add_color_tag(self.tagNameLineEdit.text(),
+                                       palette.color(QPalette.Base).name(),
+                                       palette.color(QPalette.Text).name())
 
 
 class EditColorTagDialog(QDialog):
-    def __init__(self, color_tags, index, parent=None):
+    def __init__(self, file_states, color_tag, parent=None):
         super().__init__(parent)
         loadUi("ui/new-color-tag.ui", self)
 
-        self.color_tags = color_tags
-        self.index = index
+        self.file_states = file_states
+        self.tag = color_tag[3]
 
-        self.tagNameLineEdit.setText(self.color_tags[index][0])
+        self.tagNameLineEdit.setText(color_tag[0])
         new_palette = self.exampleColors.palette()
-        new_palette.setColor(QPalette.Base, self.color_tags[index][1])
-        new_palette.setColor(QPalette.Text, self.color_tags[index][2])
+        new_palette.setColor(QPalette.Base, color_tag[1])
+        new_palette.setColor(QPalette.Text, color_tag[2])
         self.exampleColors.setPalette(new_palette)
 
         self.BaseColorButton.clicked.connect(self.base_color_picker)
@@ -102,9 +111,137 @@ class EditColorTagDialog(QDialog):
 
     def edit_color_tag(self):
         palette = self.exampleColors.palette()
-        self.color_tags[self.index] = (self.tagNameLineEdit.text(),
-                                       palette.color(QPalette.Base),
-                                       palette.color(QPalette.Text))
+        self.file_states.update_color_tag(self.tag,
+                                          self.tagNameLineEdit.text(),
+                                          palette.color(QPalette.Base).name(),
+                                          palette.color(QPalette.Text).name())
+
+
+class TagSearchDialog(QDialog):
+    """Lists every path under a directory that has a tag.
+
+    The paths come from the indexes of the file states, not from the disk, and they are added to the list in chunks
+    from a timer so the first results are shown at once and the window never stops responding.
+    """
+    path_activated = pyqtSignal(str)
+
+    CHUNK_SIZE = 500
+
+    def __init__(self, file_states, root, color_tag, parent=None):
+        super().__init__(parent)
+        loadUi("ui/tag-search.ui", self)
+
+        self.setWindowTitle(f"Find \"{color_tag[0]}\" in {root}")
+        self.results = file_states.find_under(root, color_tag[3])
+        self.count = 0
+
+        self.resultsListWidget.itemDoubleClicked.connect(lambda item: self.path_activated.emit(item.text()))
+
+        self.timer = QTimer(self)
+        self.timer.timeout.connect(self.add_results)
+        self.timer.start(0)
+
+    def add_results(self):
+        for _ in range(self.CHUNK_SIZE):
+            path = next(self.results, None)
+            if path is None:
+                self.timer.stop()
+                self.statusLabel.setText(f"{self.count} items found")
+                return
+            self.resultsListWidget.addItem(QListWidgetItem(path))
+            self.count += 1
+
+        self.statusLabel.setText(f"Searching... {self.count} items found")
+
+    def done(self, result):
+        self.timer.stop()
+        super().done(result)
+
+
+class BulkTagDialog(QDialog):
+    """Choose a tag to add to or remove from the selected items, or from the items whose names match a glob pattern or
+    a regular expression, in the current folder or also in its subfolders
+    """
+
+    def __init__(self, color_tags, has_selection, parent=None):
+        super().__init__(parent)
+        loadUi("ui/bulk-tag.ui", self)
+
+        for v in color_tags[1:]:
+            self.tagComboBox.addItem(v[0], v[3])
+        self.selectionRadioButton.setEnabled(has_selection)
+        self.patternRadioButton.setChecked(not has_selection)
+        self.patternLineEdit.textEdited.connect(lambda: self.patternRadioButton.setChecked(True))
+        self.matcher = None  # Function of the names, if the items are chosen by pattern
+
+        # With only the default tag there is nothing to add or remove
+        self.buttonBox.button(QDialogButtonBox.Ok).setEnabled(self.tagComboBox.count() > 0)
+        self.buttonBox.accepted.connect(self.check_pattern)
+
+    def check_pattern(self):
+        if self.patternRadioButton.isChecked():
+            try:
+                self.matcher = name_matcher(self.patternLineEdit.text(), self.regexCheckBox.isChecked())
+            except re.error as e:
+                QMessageBox.warning(self, "Tag items", f"Invalid regular expression: {e}")
+                return
+        self.accept()
+
+    def tag(self):
+        return self.tagComboBox.currentData()
+
+    def adds(self):
+        return self.addRadioButton.isChecked()
+
+    def recursive(self):
+        return self.recursiveCheckBox.isChecked()
+
+
+class TagStatsDialog(QDialog):
+    """Number of files and folders and size of the files of every tag, in all the store and under the current folder.
+
+    The numbers come from a TagStats, which keeps them up to date, so the table is only filled again when it says
+    that they changed or when the current folder or the color tags change.
+    """
+    HEADERS = ("Tag", "Files", "Folders", "Size", "Files here", "Folders here", "Size here")
+
+    def __init__(self, tag_stats, color_tags, current_path, parent=None):
+        super().__init__(parent)
+        loadUi("ui/tag-stats.ui", self)
+
+        self.tag_stats = tag_stats
+        self.color_tags = color_tags
+        self.current_path = current_path
+
+        self.statsTableWidget.setColumnCount(len(self.HEADERS))
+        self.statsTableWidget.setHorizontalHeaderLabels(self.HEADERS)
+        self.tag_stats.changed.connect(self.refresh)
+        self.refresh()
+
+    def refresh(self):
+        under = self.tag_stats.totals_under(self.current_path["path"])
+        self.statsTableWidget.setRowCount(len(self.color_tags))
+        for row, v in enumerate(self.color_tags):
+            values = self.tag_stats.totals.get(v[3], [0, 0, 0]) + under.get(v[3], [0, 0, 0])
+            texts = [v[0]] + [format_size(value) if i % 3 == 2 else str(value) for i, value in enumerate(values)]
+            for column, text in enumerate(texts):
+                item = QTableWidgetItem(text)
+                if column == 0:
+                    item.setBackground(v[1])
+                    item.setForeground(v[2])
+                else:
+                    item.setTextAlignment(Qt.AlignRight | Qt.AlignVCenter)
+                self.statsTableWidget.setItem(row, column, item)
+        self.statsTableWidget.resizeColumnsToContents()
+
+        if self.tag_stats.is_reading():
+            self.statusLabel.setText(f"Reading the sizes... {len(self.tag_stats.pending)} items left")
+        else:
+            self.statusLabel.setText(f"Under {self.current_path['path']}")
+
+    def done(self, result):
+        self.tag_stats.changed.disconnect(self.refresh)
+        super().done(result)
 
 
 class EditTagsDialog(QDialog, Ui_EditTagsDialog):
@@ -135,8 +272,9 @@ class EditTagsDialog(QDialog, Ui_EditTagsDialog):
         print(f"Edit tag: {self.listView.selectedIndexes()[0].data()}")
         index, _ = self.listView.selectedIndexes()[0].data().split(": ")
         index = int(index)
-        dialog = EditColorTagDialog(self.color_tags, index, self)
+        dialog = EditColorTagDialog(self.file_states, self.color_tags[index], self)
         dialog.exec()
+        self.refresh_color_tags()
 
     def delete_tag(self, index):
         if len(self.listView.selectedIndexes()) == 0:
@@ -145,16 +283,8 @@ class EditTagsDialog(QDialog, Ui_EditTagsDialog):
         print(f"Delete tag: {self.listView.selectedIndexes()[0].data()}")
         index, _ = self.listView.selectedIndexes()[0].data().split(": ")
         index = int(index)
-        self.color_tags.pop(index)
-        items = list(self.file_states.items())
-        for k, v in items:
-            if v == index:
-                self.file_states.pop(k)
-            elif v > index:
-                self.file_states[k] = v - 1
-
-        self.model.clear()
-        self.append_items_to_model()
+        self.file_states.delete_color_tag(self.color_tags[index][3])
+        self.refresh_color_tags()
 
     def move_up(self):
         if len(self.listView.selectedIndexes()) == 0:
@@ -163,16 +293,8 @@ class EditTagsDialog(QDialog, Ui_EditTagsDialog):
         print(f"Move up item: {self.listView.selectedIndexes()[0].data()}")
         index, _ = self.listView.selectedIndexes()[0].data().split(": ")
         index = int(index)
-        if index > 1:
-            self.color_tags[index], self.color_tags[index - 1] = self.color_tags[index - 1], self.color_tags[index]
-            for k, v in self.file_states.items():
-                if v == index:
-                    self.file_states[k] -= 1
-                elif v == index - 1:
-                    self.file_states[k] += 1
-
-        self.model.clear()
-        self.append_items_to_model()
+        self.file_states.move_color_tag(self.color_tags[index][3], -1)
+        self.refresh_color_tags()
 
     def move_down(self):
         if len(self.listView.selectedIndexes()) == 0:
@@ -181,14 +303,12 @@ class EditTagsDialog(QDialog, Ui_EditTagsDialog):
         print(f"Move down item: {self.listView.selectedIndexes()[0].data()}")
         index, _ = self.listView.selectedIndexes()[0].data().split(": ")
         index = int(index)
-        if index < len(self.color_tags):
-            self.color_tags[index], self.color_tags[index + 1] = self.color_tags[index + 1], self.color_tags[index]
-            for k, v in self.file_states.items():
-                if v == index:
-                    self.file_states[k] += 1
-                elif v == index + 1:
-                    self.file_states[k] -= 1
+        self.file_states.move_color_tag(self.color_tags[index][3], 1)
+        self.refresh_color_tags()
 
+    def refresh_color_tags(self):
+        """Copy the color tags of the tag store to the list shared with the main window and show them again"""
+        self.color_tags[:] = qt_color_tags(self.file_states.color_tags)
         self.model.clear()
         self.append_items_to_model()
 
@@ -1,62 +1,114 @@
-import json
 import os.path
-import shutil
 import subprocess
 import sys
+import time
 
 from PyQt5 import QtWidgets
-from PyQt5.QtCore import Qt, QItemSelectionModel
-from PyQt5.QtGui import QColor, QContextMenuEvent
-from PyQt5.QtWidgets import QMainWindow, QFileSystemModel, QListView, QStyledItemDelegate
+from PyQt5.QtCore import Qt, QItemSelectionModel, QPersistentModelIndex, QPoint, QSortFilterProxyModel, QTimer, \
+    pyqtSignal
+from PyQt5.QtGui import QBrush, QColor, QContextMenuEvent, QKeySequence, QPalette, QPen
+from PyQt5.QtWidgets import QMainWindow, QFileSystemModel, QInputDialog, QListView, QMessageBox, QProgressBar, \
+    QStyledItemDelegate, QStyleOptionViewItem
 
 from app.ui.main_window import Ui_MainWindow
-from app.src.dialogs import EditTagsDialog, NewColorTagDialog, NewFileDialog, NewFolderDialog
+from app.src.dialogs import BulkTagDialog, EditTagsDialog, NewColorTagDialog, NewFileDialog, NewFolderDialog, \
+    TagSearchDialog, TagStatsDialog, qt_color_tags
+from app.src.file_operations import COPY, DELETE, MOVE, FileJob, FileOperationQueue, find_matching
+from app.src.icon_provider import CachedIconProvider
+from app.src.navigation_cache import NavigationCache
+from app.src import profiling
+from app.src.profile_overlay import ProfileOverlay
+from app.src.profiling import probe, span
+from app.src.tag_collector import TagCollector
+from app.src.tag_filter import FilterError, TagFilter
+from app.src.tag_stats import TagStats
+from app.src.tag_store import DEFAULT_MASK, TagStore, in_tree
+from app.src.tag_watcher import TagWatcher
+from app.src.xattr_sync import XattrSync
+
+UNDO_LIMIT = 20  # Number of tag changes that can be undone
+LARGE_DIRECTORY = 10000  # Entries above which a directory is shown in the large-directory mode
+LAYOUT_BATCH_SIZE = 1000  # Rows the view lays out at once in the large-directory mode
+HEADER_PADDING = 8  # Pixels of the header of a group of items over the height of its text
+SYNC_INTERVAL = 1000  # Milliseconds between reads of the changes that other processes wrote to the metadata file
+
+# Orders of the items of the view
+DEFAULT_ORDER = "default"
+BY_TAG = "tag"
+GROUPED = "grouped"
 
 
 class FileExplorerApp(QMainWindow, Ui_MainWindow):
     """Controller of the main window"""
 
-    def __init__(self, meta_file: str = "meta.json"):
+    def __init__(self, meta_file: str = "meta.json", xattrs: bool = False, large_directory: int = LARGE_DIRECTORY):
         """
         Init method
 
         :param meta_file: Relative path of the metadata file
+        :param xattrs: Whether the tags are also kept in extended attributes of the files
+        :param large_directory: Entries above which a directory is shown in the large-directory mode
         """
         super().__init__()
         self.setupUi(self)
         self.meta_file = meta_file
+        self.large_directory = large_directory
 
         # It's a dictionary so that we can modify its value and all the classes can see the current value
         self.current_path = {"path": os.path.expanduser("~")}  # Find home dir in windows and linux
         print(f"Home directory's path: {self.current_path['path']}")
 
-        # If the metadata file exists, loads the file states and color tags, if not loads the default tags
-        self.file_states = {}
-        self.color_tags = []
-        if os.path.exists(self.meta_file):
-            with open(self.meta_file, "r") as f:
-                meta_data = json.loads(f.read())
-                self.file_states = meta_data["file-states"]
-                tags_data = meta_data["color-tags"]
-                for v in tags_data:
-                    self.color_tags.append((v[0], QColor(v[1]), QColor(v[2])))
-        else:
-            self.color_tags = [("normal tag", Qt.white, Qt.black),
-                               ("special tag", Qt.yellow, Qt.black),
-                               ("urgent tag", Qt.red, Qt.white)]
+        # Loads the file states and color tags from the metadata file and its journal, or the default tags if there
+        # isn't a metadata file. Every change to the file states is saved as soon as it's done. Only the tags of the
+        # shown directory are read before the window appears, the rest of the index is parsed once the event loop runs
+        self.file_states = TagStore(self.meta_file)
+        self.color_tags = qt_color_tags(self.file_states.color_tags)
 
         self.setWindowTitle("Color Tag File Explorer")
         self.setGeometry(100, 100, 800, 600)
 
         self.file_model = QFileSystemModel()
-        self.list_selection_model = QItemSelectionModel(self.file_model)
+        # The model keeps a pointer to the provider, it must live as long as the window. The delegate asks it for
+        # the icons of the rows that are painted, since the source model keeps the placeholder of a new extension
+        self.icon_provider = CachedIconProvider()
+        self.file_model.setIconProvider(self.icon_provider)
+        self.proxy_model = TagFilterProxyModel(self.file_states, self.current_path)
+        self.proxy_model.setSourceModel(self.file_model)
+        self.list_selection_model = QItemSelectionModel(self.proxy_model)
 
         self.clipboard_items = []
         self.was_cut_selected = False
 
-        self.last_filter = -1  # Index of the last applied filter
+        # Copy, move and delete run in worker threads, the tags are updated when every job finishes
+        self.file_operations = FileOperationQueue(parent=self)
+        self.cancel_button = QtWidgets.QPushButton("Cancel")
+        # Busy indicator while a large directory is being loaded
+        self.loading_bar = QProgressBar()
+        self.large_mode = False
+
+        # Renames, moves and deletes done by other programs in the visited directories carry or remove the tags
+        self.tag_watcher = TagWatcher(self.file_states, parent=self)
+        # The tags of the paths deleted by anything else are removed in the background
+        self.tag_collector = TagCollector(self.file_states, self.tag_watcher.entries, parent=self)
+        # Numbers of every tag, read in the background the first time they're shown and then kept up to date
+        self.tag_stats = TagStats(self.file_states, parent=self)
+        self.stats_dialog = None
+        # Tags in the extended attributes of the files, which travel with them
+        self.xattr_sync = XattrSync(self.file_states, parent=self) if xattrs else None
+        # How the last visited folders were shown, and the folders that are read before they're opened
+        self.navigation = NavigationCache(self.file_states, self.file_model, parent=self)
+        # Tags changed by other windows and scripts, read from the end of the journal of the metadata file
+        self.sync_timer = QTimer(self)
+        self.sync_timer.timeout.connect(self.sync_tags)
+        self.sync_timer.start(SYNC_INTERVAL)
+
+        self.undo_stack = []  # (description, {path: previous mask}) of the last tag changes, the newest last
+        self.last_filter = -1  # Id of the tag of the last applied filter, or the text of the filter expression
+        self.order = DEFAULT_ORDER
+        self.populating = None  # (path, start time) of the directory being loaded when profiling
 
         self.init_ui()
+        QTimer.singleShot(0, self.file_states.ensure_index)
 
     def init_ui(self):
         self.file_model.setRootPath(self.current_path["path"])
@@ -69,16 +121,54 @@ class FileExplorerApp(QMainWindow, Ui_MainWindow):
         self.actionPaste.triggered.connect(self.paste_items)
         self.actionDelete.triggered.connect(self.delete_items)
         self.actionSelect_All.triggered.connect(self.listView.selectAll)
-
+        self.menuEdit.addSeparator()
+        self.undo_action = self.menuEdit.addAction("Undo tagging", self.undo_tagging)
+        self.undo_action.setShortcut(QKeySequence.Undo)
+        self.undo_action.setEnabled(False)
+        self.copy_tags_action = self.menuEdit.addAction("Copies keep the tags")
+        self.copy_tags_action.setCheckable(True)
+        self.copy_tags_action.setChecked(True)
+
+        self.file_operations.progress.connect(self.show_job_progress)
+        self.file_operations.finished.connect(self.commit_job)
+        self.cancel_button.clicked.connect(self.file_operations.cancel_all)
+        self.cancel_button.hide()
+        self.statusbar.addPermanentWidget(self.cancel_button)
+        self.loading_bar.setRange(0, 0)
+        self.loading_bar.setMaximumWidth(150)
+        self.loading_bar.hide()
+        self.statusbar.addPermanentWidget(self.loading_bar)
+        self.file_model.rowsInserted.connect(self.rows_inserted)
+        self.file_model.directoryLoaded.connect(self.directory_loaded)
+        self.tag_watcher.tags_changed.connect(self.refresh_tags)
+        self.tag_collector.pass_finished.connect(self.show_collected)
+        self.tag_collector.start()
+        if self.xattr_sync is not None:
+            self.xattr_sync.tags_changed.connect(self.refresh_tags)
+            self.tag_watcher.watcher.directoryChanged.connect(self.xattr_sync.directory_changed)
+
+        self.menuView = QtWidgets.QMenu("View", self.menubar)
+        self.menubar.insertMenu(self.menuTags.menuAction(), self.menuView)
+        order_group = QtWidgets.QActionGroup(self)
+        for text, order in (("Default order", DEFAULT_ORDER), ("Sort by tag", BY_TAG), ("Group by tag", GROUPED)):
+            action = self.menuView.addAction(text)
+            action.setCheckable(True)
+            action.setChecked(order == self.order)
+            action.triggered.connect(lambda _, o=order: self.set_order(o))
+            order_group.addAction(action)
+
+        self.toggle_tag_menu = self.menuTags.addMenu("Toggle on selection")
         self.refresh_filter_menu()
 
         self.actionAdd_new_tag.triggered.connect(self.open_new_color_tag_dialog)
         self.actionEdit_tag.triggered.connect(self.open_edit_tags_dialog)
+        self.menuTags.addAction("Tag items...", self.open_bulk_tag_dialog)
+        self.menuTags.addAction("Statistics...", self.open_stats_dialog)
 
         self.folderUpButton.clicked.connect(self.go_folder_up)
 
-        self.listView.setModel(self.file_model)
-        self.listView.setRootIndex(self.file_model.index(self.current_path["path"]))
+        self.listView.setModel(self.proxy_model)
+        self.change_directory(self.current_path["path"])
         self.listView.doubleClicked.connect(self.open_file)
 
         self.listView.setDragEnabled(True)
@@ -88,39 +178,81 @@ class FileExplorerApp(QMainWindow, Ui_MainWindow):
         self.listView.setDropIndicatorShown(True)
 
         self.listView.setSelectionModel(self.list_selection_model)
-
-        delegate = ColorDelegate(self.list_selection_model,
-                                 self.file_model,
-                                 self.listView,
-                                 self.current_path,
-                                 self.file_states,
-                                 self.color_tags)
-        self.listView.setItemDelegate(delegate)
+        # The folder under the mouse or the keyboard cursor is read before it's opened
+        self.listView.setMouseTracking(True)
+        self.listView.entered.connect(self.item_hovered)
+        self.list_selection_model.currentChanged.connect(self.item_hovered)
+
+        self.delegate = ColorDelegate(self.list_selection_model,
+                                      self.file_model,
+                                      self.listView,
+                                      self.current_path,
+                                      self.file_states,
+                                      self.color_tags)
+        self.listView.setItemDelegate(self.delegate)
+        self.icon_provider.icons_ready.connect(self.icons_ready)
+        self.proxy_model.resorted.connect(self.delegate.invalidate)
+
+        # Timing probes, only with the COLOR_TAGS_PROFILE environment variable
+        if profiling.ENABLED:
+            self.statusbar.addPermanentWidget(ProfileOverlay(self.listView.viewport(), self.icon_provider, self))
 
     def refresh_filter_menu(self):
         """Clear the menu of filters and add all the actions again. It's called after a new tag is added of after the
         edit-tags dialog it's closed
         """
         self.menuFilter.clear()
-        for k, v in enumerate(self.color_tags):
+        for v in self.color_tags:
             action = QtWidgets.QWidgetAction(self.menuFilter)
-            action.triggered.connect(lambda _, i=k: self.filter_tag(i))
-            label = QtWidgets.QLabel(v[0])
-            label.setStyleSheet(f"QLabel {{ background-color: {v[1].name()}; color: {v[2].name()}; padding: 5px}}")
-            action.setDefaultWidget(label)
+            action.triggered.connect(lambda _, i=v[3]: self.filter_tag(i))
+            action.setDefaultWidget(self.tag_label(v))
             self.menuFilter.addAction(action)
+        self.menuFilter.addAction("Expression...", self.filter_expression)
+
+        # Search of the tagged items in all the subfolders of the current folder
+        self.menuFilter.addSeparator()
+        find_menu = self.menuFilter.addMenu("Find in subfolders")
+        for v in self.color_tags[1:]:
+            action = QtWidgets.QWidgetAction(find_menu)
+            action.triggered.connect(lambda _, tag=v: self.find_tag(tag))
+            action.setDefaultWidget(self.tag_label(v))
+            find_menu.addAction(action)
+
+        # The items can have several tags, these add or remove one without touching the others
+        self.toggle_tag_menu.clear()
+        for v in self.color_tags[1:]:
+            action = QtWidgets.QWidgetAction(self.toggle_tag_menu)
+            action.triggered.connect(lambda _, tag=v[3]: self.toggle_tag(tag))
+            action.setDefaultWidget(self.tag_label(v))
+            self.toggle_tag_menu.addAction(action)
+
+    @staticmethod
+    def tag_label(color_tag):
+        label = QtWidgets.QLabel(color_tag[0])
+        label.setStyleSheet(f"QLabel {{ background-color: {color_tag[1].name()}; color: {color_tag[2].name()}; "
+                            f"padding: 5px}}")
+        return label
 
     def closeEvent(self, event):
         print("Close button or Alt+F4 was pressed.")
 
-        with open(self.meta_file, "w") as f:
-            serializable_tags = []
-            for v in self.color_tags:
-                serializable_tags.append((v[0], v[1].name(), v[2].name()))
-
-            data = {"file-states": self.file_states,
-                    "color-tags": serializable_tags}
-            json.dump(data, f, indent=2)
+        # The running jobs stop at the next file or chunk and their finished items still update the tags
+        self.file_operations.cancel_all()
+        self.file_operations.pool.waitForDone()
+        QtWidgets.QApplication.processEvents()
+        self.sync_timer.stop()
+        self.tag_watcher.stop()
+        self.tag_collector.stop()
+        self.tag_stats.close()
+        self.icon_provider.stop()
+        self.navigation.stop()
+        if self.xattr_sync is not None:
+            self.xattr_sync.stop()
+
+        with span("save"):
+            self.file_states.close()
+        if profiling.TRACE_FILE:
+            profiling.profiler.export_trace(profiling.TRACE_FILE)
 
         event.accept()
 
@@ -137,76 +269,491 @@ class FileExplorerApp(QMainWindow, Ui_MainWindow):
                 opener = "open" if sys.platform == "darwin" else "xdg-open"
                 subprocess.call([opener, new_path])
         else:
-            self.listView.setRootIndex(self.file_model.index(new_path))
-            self.current_path["path"] = new_path
-            self.last_filter = -1
+            self.change_directory(new_path)
 
     def go_folder_up(self):
-        self.current_path["path"] = os.path.dirname(self.current_path["path"])
-        self.listView.setRootIndex(self.file_model.index(self.current_path["path"]))
-        self.last_filter = -1
+        self.change_directory(os.path.dirname(self.current_path["path"]))
+
+    @probe("navigate")
+    def change_directory(self, path):
+        """Show the content of a directory. The active filter is kept and applied to the new directory"""
+        if profiling.ENABLED:
+            self.populating = (path, time.perf_counter())
+        if hasattr(self, "delegate"):
+            top = self.listView.indexAt(QPoint(0, 0))
+            self.navigation.save(self.current_path["path"], (self.proxy_model.tag_filter, self.order),
+                                 top.data() if top.isValid() else None, self.delegate.cached_rows())
+        self.current_path["path"] = path
+        self.file_states.open_directory(path)
+        self.tag_watcher.watch(path)
+        if self.xattr_sync is not None:
+            self.xattr_sync.read(path)
+        self.proxy_model.set_root(self.file_model.index(path))
+        if hasattr(self, "delegate"):
+            self.delegate.invalidate()
+        self.listView.setRootIndex(self.proxy_model.mapFromSource(self.file_model.index(path)))
+        # A directory that the model already has is known to be large before any row comes
+        self.loading_bar.hide()
+        self.set_large_mode(self.file_model.rowCount(self.file_model.index(path)) > self.large_directory)
+        self.restore_view(path)
+        self.navigation.prefetch(os.path.dirname(path))
+        if self.stats_dialog is not None:
+            self.stats_dialog.refresh()
+
+    def set_order(self, order):
+        """Show the items in the order of QFileSystemModel, by tag and name, or by tag and name with the name of every
+        tag over its items
+        """
+        self.order = order
+        self.proxy_model.set_tag_order(order != DEFAULT_ORDER)
+        self.delegate.set_group_by_tag(order == GROUPED)
+        # The headers make the rows of different sizes
+        self.listView.setUniformItemSizes(self.large_mode and order != GROUPED)
+        self.listView.doItemsLayout()
+
+    def restore_view(self, path):
+        """Show a folder that was visited recently at the same place, with the rows that were already prepared"""
+        state = self.navigation.restore(path, (self.proxy_model.tag_filter, self.order))
+        if state is None or not hasattr(self, "delegate"):
+            return
+        top_name, rows = state
+        if rows is not None:
+            self.delegate.restore_rows(rows)
+        if top_name is not None:
+            top = self.proxy_model.mapFromSource(self.file_model.index(os.path.join(path, top_name)))
+            if top.isValid():
+                self.listView.scrollTo(top, QListView.PositionAtTop)
+
+    def item_hovered(self, index):
+        if index.isValid():
+            source_index = self.proxy_model.mapToSource(index)
+            if self.file_model.isDir(source_index):
+                self.navigation.prefetch(self.file_model.filePath(source_index), under_cursor=True)
 
     def copy_items(self):
-        self.clipboard_items = [os.path.join(self.current_path["path"], index.data())
-                                for index in self.listView.selectedIndexes()]
+        self.clipboard_items = self.selected_paths()
 
     def cut_items(self):
         self.copy_items()
         self.was_cut_selected = True
 
     def paste_items(self):
-        if self.was_cut_selected:
-            for path in self.clipboard_items:
-                shutil.move(path, self.current_path["path"])
-            self.was_cut_selected = False
-        else:
-            for path in self.clipboard_items:
-                # Only copies files
-                if os.path.isfile(path):
-                    shutil.copy(path, self.current_path["path"])
+        if not self.clipboard_items:
+            return
 
+        kind = MOVE if self.was_cut_selected else COPY
+        self.submit_job(FileJob(kind, self.clipboard_items, self.current_path["path"]))
+        self.was_cut_selected = False
         self.clipboard_items = []
 
     def delete_items(self):
-        for item in self.listView.selectedIndexes():
-            temp_path = os.path.join(self.current_path["path"], item.data())
-            if os.path.isfile(temp_path):
-                os.remove(temp_path)
-            elif os.path.isdir(temp_path):
-                os.removedirs(temp_path)
+        paths = self.selected_paths()
+        if paths:
+            self.submit_job(FileJob(DELETE, paths))
+
+    def submit_job(self, job):
+        self.file_operations.submit(job)
+        self.cancel_button.show()
+        self.statusbar.showMessage(f"{job.description()}...")
+
+    def show_job_progress(self, job):
+        self.statusbar.showMessage(f"{job.description()}: {job.percent()}%")
+
+    def commit_job(self, job):
+        """Update in one batch the tags of the items that the job copied, moved or deleted"""
+        with self.file_states.batch():
+            for source, target in job.results:
+                if job.kind == MOVE:
+                    self.file_states.move_tree(source, target)
+                elif job.kind == COPY:
+                    if self.copy_tags_action.isChecked():
+                        self.file_states.copy_tree(source, target)
+                else:
+                    self.file_states.remove_tree(source)
+        self.refresh_tags()
+
+        if job.error is None:
+            self.statusbar.showMessage(f"{job.description()}: done", 5000)
+        else:
+            self.statusbar.showMessage(f"{job.description()}: {job.error}", 5000)
+        if not self.file_operations.jobs:
+            self.cancel_button.hide()
+
+    def set_large_mode(self, large):
+        """Lay out the rows of the view in batches, assuming they all have the size of the first one, so a directory
+        with hundreds of thousands of entries doesn't stop the window while it's loaded or filtered. The row sizes
+        aren't measured one by one, and the delegate still looks up the tags of the painted rows only
+        """
+        if large == self.large_mode:
+            return
+        self.large_mode = large
+        self.listView.setUniformItemSizes(large and self.order != GROUPED)
+        self.listView.setLayoutMode(QListView.Batched if large else QListView.SinglePass)
+        self.listView.setBatchSize(LAYOUT_BATCH_SIZE if large else 100)
+
+    def rows_inserted(self, parent, first, last):
+        # The model adds the rows of the shown directory in chunks while it reads it
+        if parent != self.file_model.index(self.current_path["path"]):
+            return
+        rows = self.file_model.rowCount(parent)
+        if not self.large_mode and rows > self.large_directory:
+            self.set_large_mode(True)
+            self.loading_bar.show()
+        if self.loading_bar.isVisible():
+            self.statusbar.showMessage(f"Loading: {rows} items...")
+
+    def directory_loaded(self, path):
+        if path == self.current_path["path"] and self.loading_bar.isVisible():
+            self.loading_bar.hide()
+            self.statusbar.showMessage(f"{self.file_model.rowCount(self.file_model.index(path))} items", 5000)
+
+        # The model fills the directory in a thread, until then the view shows only part of it
+        if self.populating is not None and self.populating[0] == path:
+            start = self.populating[1]
+            profiling.profiler.record("populate", start, time.perf_counter() - start)
+            self.populating = None
+
+    def show_collected(self, reclaimed):
+        if reclaimed:
+            self.statusbar.showMessage(f"Removed the tags of {reclaimed} deleted items", 5000)
+
+    def refresh_tags(self):
+        """Filter and repaint the shown items again after their tags were changed from outside the view"""
+        self.proxy_model.refresh()
+        self.delegate.invalidate()
+        self.listView.viewport().update()
+
+    def sync_tags(self):
+        """Show the tags and the color tags that other processes changed in the metadata file"""
+        color_tags = self.file_states.color_tags
+        if not self.file_states.sync():
+            return
+        if self.file_states.color_tags != color_tags:
+            self.color_tags[:] = qt_color_tags(self.file_states.color_tags)
+            self.navigation.forget_rows()
+            self.delegate.refresh_colors()
+            self.refresh_filter_menu()
+            if self.stats_dialog is not None:
+                self.stats_dialog.refresh()
+        self.refresh_tags()
+
+    def icons_ready(self):
+        """Repaint the rows that were painted with a placeholder while the icons of their extensions were found"""
+        self.navigation.forget_rows()
+        self.delegate.forget_icons()
+        self.listView.viewport().update()
 
     def open_new_color_tag_dialog(self):
-        dialog = NewColorTagDialog(self.color_tags, self)
+        dialog = NewColorTagDialog(self.file_states, self)
         dialog.exec()
+        self.color_tags[:] = qt_color_tags(self.file_states.color_tags)
+        self.delegate.refresh_colors()
         self.refresh_filter_menu()
+        if self.stats_dialog is not None:
+            self.stats_dialog.refresh()
 
     def open_edit_tags_dialog(self):
         dialog = EditTagsDialog(self.color_tags, self.file_states, self)
         dialog.exec()
+        # The order of the tags decides the color and the place of the items with several
+        self.navigation.forget_rows()
+        self.proxy_model.refresh()
+        self.delegate.refresh_colors()
         self.refresh_filter_menu()
+        if self.stats_dialog is not None:
+            self.stats_dialog.refresh()
+
+    def open_stats_dialog(self):
+        if self.stats_dialog is not None:
+            self.stats_dialog.raise_()
+            return
+        if not self.tag_stats.started:
+            self.tag_stats.start()
+        self.stats_dialog = TagStatsDialog(self.tag_stats, self.color_tags, self.current_path, self)
+        self.stats_dialog.setAttribute(Qt.WA_DeleteOnClose)
+        self.stats_dialog.finished.connect(self.stats_dialog_closed)
+        self.stats_dialog.show()
+
+    def stats_dialog_closed(self):
+        self.stats_dialog = None
+
+    def find_tag(self, color_tag):
+        dialog = TagSearchDialog(self.file_states, self.current_path["path"], color_tag, self)
+        dialog.path_activated.connect(lambda path: self.change_directory(os.path.dirname(path)))
+        dialog.setAttribute(Qt.WA_DeleteOnClose)
+        dialog.show()
 
     def filter_tag(self, index):
         print(f"Filter index: {index}")
 
-        for file in os.listdir(self.current_path["path"]):
-            path = os.path.join(self.current_path["path"], file)
-            file_id = self.file_model.index(path)
+        # If the last filter it's equal to index, show all the items
+        if self.last_filter == index:
+            index = -1
 
-            # If the last filter it's equal to index, show all the items
-            if self.last_filter == index:
-                self.listView.setRowHidden(file_id.row(), False)
+        self.proxy_model.set_tag_filter(None if index == -1 else TagFilter.for_tag(index))
+        self.last_filter = index
+
+    def filter_expression(self):
+        """Ask for a filter that combines tags, like "urgent OR special, NOT normal". An empty one shows all the
+        items
+        """
+        text = self.last_filter if isinstance(self.last_filter, str) else ""
+        while True:
+            text, accepted = QInputDialog.getText(self, "Filter", "Tags with AND, OR, NOT and commas:", text=text)
+            if not accepted:
+                return
+            if not text.strip():
+                self.proxy_model.set_tag_filter(None)
+                self.last_filter = -1
+                return
+            try:
+                tag_filter = TagFilter.parse(text, self.file_states.color_tags)
+            except FilterError as e:
+                QMessageBox.warning(self, "Filter", str(e))
                 continue
+            self.proxy_model.set_tag_filter(tag_filter)
+            self.last_filter = text
+            return
+
+    def selected_paths(self):
+        return [os.path.join(self.current_path["path"], index.data()) for index in self.listView.selectedIndexes()]
+
+    def toggle_tag(self, tag):
+        """Add a tag to the selected items, or remove it if all of them have it"""
+        masks = {path: self.file_states.get_mask(path, 0) for path in self.selected_paths()}
+        if not masks:
+            return
+        if all(mask >> tag & 1 for mask in masks.values()):
+            self.apply_tags("Remove tag", {path: mask & ~(1 << tag) for path, mask in masks.items()})
+        else:
+            self.apply_tags("Add tag", {path: mask | 1 << tag for path, mask in masks.items()})
+
+    def open_bulk_tag_dialog(self):
+        """Add or remove a tag on the selected items or on the items whose names match a pattern"""
+        paths = self.selected_paths()
+        dialog = BulkTagDialog(self.color_tags, bool(paths), self)
+        if not dialog.exec():
+            return
+        tag = dialog.tag()
+        if tag is None:
+            return
+
+        if dialog.matcher is not None:
+            paths = find_matching(self.current_path["path"], dialog.matcher, dialog.recursive())
+        if dialog.adds():
+            masks = {path: self.file_states.get_mask(path, 0) | 1 << tag for path in paths}
+        else:
+            masks = {path: self.file_states.get_mask(path, 0) & ~(1 << tag) for path in paths}
+        self.apply_tags("Add tag" if dialog.adds() else "Remove tag", masks)
+
+    def apply_tags(self, description, masks):
+        """Set the tags of many items in a single journal write and repaint, and keep what they had to undo it
+
+        :param masks: {path: mask}, an empty mask removes the tags of the path
+        """
+        previous = self.file_states.set_masks(masks)
+        self.statusbar.showMessage(f"{description}: {len(previous)} items changed", 5000)
+        if not previous:
+            return
+
+        self.undo_stack.append((description, previous))
+        del self.undo_stack[:-UNDO_LIMIT]
+        self.undo_action.setEnabled(True)
+        self.refresh_tags()
+
+    def undo_tagging(self):
+        if not self.undo_stack:
+            return
+        description, previous = self.undo_stack.pop()
+        self.file_states.set_masks(previous)
+        self.undo_action.setEnabled(bool(self.undo_stack))
+        self.refresh_tags()
+        self.statusbar.showMessage(f"Undone: {description} on {len(previous)} items", 5000)
+
+
+class TagFilterProxyModel(QSortFilterProxyModel):
+    """Hides the items of the shown directory that don't match the tag filter, and sorts them by tag.
+
+    Rows that QFileSystemModel adds while it's loading a directory go through the filter when they are inserted, so
+    the filter is applied without doing anything when the user enters a new directory.
+
+    Sorted by tag, the items are in the display order of their main tag, and then by name. The rank of every
+    different mask of the directory is found once, and the key of every item is built the first time it's compared
+    and kept by the node of QFileSystemModel, which doesn't change when the model sorts its rows. So most comparisons
+    only compare two keys of a dictionary. When an item gets another tag, only its key changes, and only its row is
+    moved to its new place. The changes done together, like the ones of a batch, are gathered until the event loop
+    runs again, and if there are several, or a moved or copied tree changed the directory, it's sorted once instead.
+    """
+    # The rows were sorted again. The layoutChanged of a sort has no parents, like the ones of QFileSystemModel when it
+    # sorts the folders it reads in the background, so it doesn't tell whether the shown rows moved
+    resorted = pyqtSignal()
+
+    def __init__(self, file_states, current_path, parent=None):
+        super().__init__(parent)
+        self.file_states = file_states
+        self.current_path = current_path
 
-            if ((path not in self.file_states and index != 0) or
-                    (path in self.file_states and self.file_states[path] != index)):
-                self.listView.setRowHidden(file_id.row(), True)
+        self.tag_filter = None
+        self.root = QPersistentModelIndex()
+
+        self.tag_order = False
+        self.ranks = {}  # Name -> position of its main tag in the display order, if it isn't default_rank
+        self.default_rank = 0  # Rank of the untagged items
+        self.row_keys = {}  # Internal id of an item of the shown directory -> (rank, name in lowercase)
+        self.changed = {}  # Name -> mask of the items of the shown directory whose rows weren't moved yet
+        self.tree_changed_here = False  # Whether a moved or copied tree changed the shown directory meanwhile
+        self.move_timer = QTimer(self)
+        self.move_timer.setSingleShot(True)
+        self.move_timer.timeout.connect(self.move_changed)
+        self.file_states.listeners.append(self.path_changed)
+        self.file_states.tree_listeners.append(self.tree_changed)
+
+    def setSourceModel(self, model):
+        super().setSourceModel(model)
+        # The id of a removed item could be given to a new one
+        model.rowsAboutToBeRemoved.connect(self.source_rows_removed)
+        model.modelAboutToBeReset.connect(self.row_keys.clear)
+
+    @probe("filter")
+    def set_tag_filter(self, tag_filter):
+        """Show only the items that match a TagFilter, or all of them if it's None. Untagged items count as the first
+        tag
+        """
+        if tag_filter != self.tag_filter:
+            self.tag_filter = tag_filter
+            self.prepare()
+            self.invalidateFilter()
+
+    def set_root(self, source_index):
+        """Set the directory whose items are filtered, the rest of the tree isn't"""
+        self.root = QPersistentModelIndex(source_index)
+        self.refresh()
+
+    def set_tag_order(self, tag_order):
+        """Sort the items by tag, or leave them in the order of the source model"""
+        if tag_order != self.tag_order:
+            self.tag_order = tag_order
+            self.prepare()
+            self.sort(0 if tag_order else -1)
+
+    def refresh(self):
+        """Apply the filter and the order again because the directory, the tags of the items or the display order of
+        the tags changed
+        """
+        self.changed.clear()
+        self.tree_changed_here = False
+        self.move_timer.stop()
+        if self.tag_order:
+            self.prepare()
+            self.invalidate()
+            self.resorted.emit()
+        elif self.tag_filter is not None:
+            self.prepare()
+            self.invalidateFilter()
+
+    def prepare(self):
+        # The filter is evaluated once for every different mask of the directory, before the rows ask for it
+        tagged = self.file_states.tagged_in(self.current_path["path"])
+        if self.tag_filter is not None:
+            self.tag_filter.prepare(tagged.masks)
+            self.tag_filter.prepare((DEFAULT_MASK,))
+        # And so is the rank of the main tag
+        if self.tag_order:
+            mask_ranks = {mask: self.mask_rank(mask) for mask in set(tagged.masks)}
+            self.default_rank = self.mask_rank(DEFAULT_MASK)
+            self.ranks = {name: mask_ranks[mask] for name, mask in tagged.items()
+                          if mask_ranks[mask] != self.default_rank}
+            self.row_keys.clear()
+
+    def mask_rank(self, mask):
+        main_tag = self.file_states.main_tag(mask)
+        return next((i for i, v in enumerate(self.file_states.color_tags) if v[3] == main_tag),
+                    len(self.file_states.color_tags))
+
+    def tag_rank(self, index):
+        """Position in the display order of the main tag of an item of the shown directory"""
+        return self.ranks.get(index.data(), self.default_rank)
+
+    def source_rows_removed(self, parent, first, last):
+        if parent == self.root:
+            self.row_keys.clear()
+
+    def sort_key(self, index):
+        # The rows of the other directories aren't shown, they stay in the order of the source model
+        if index.parent() != self.root:
+            return index.row()
+        name = index.data()
+        key = self.row_keys[index.internalId()] = (self.ranks.get(name, self.default_rank), name.lower())
+        return key
+
+    def lessThan(self, left, right):
+        keys = self.row_keys
+        try:
+            return keys[left.internalId()] < keys[right.internalId()]
+        except KeyError:
+            return self.sort_key(left) < self.sort_key(right)
+
+    def path_changed(self, path, mask):
+        if not self.tag_order or path is None:
+            return
+        directory, name = os.path.split(path)
+        if directory != self.current_path["path"]:
+            return
+        self.changed[name] = mask
+        if not self.move_timer.isActive():
+            self.move_timer.start(0)
+
+    def tree_changed(self, op, source, target):
+        if not self.tag_order:
+            return
+        directory = self.current_path["path"]
+        for root in (source, target) if op == "move" else (target,):
+            if os.path.dirname(root) == directory or in_tree(directory, root):
+                self.tree_changed_here = True
+                if not self.move_timer.isActive():
+                    self.move_timer.start(0)
+
+    def move_changed(self):
+        changed, self.changed = self.changed, {}
+        if not self.tag_order:
+            return
+        if len(changed) > 1 or self.tree_changed_here:
+            self.refresh()
+            return
+
+        for name, mask in changed.items():
+            rank = self.mask_rank(mask) if mask else self.default_rank
+            if rank == self.ranks.get(name, self.default_rank):
+                return
+            if rank == self.default_rank:
+                del self.ranks[name]
             else:
-                self.listView.setRowHidden(file_id.row(), False)
+                self.ranks[name] = rank
+            # A row whose data changes is moved to its sorted place with a binary search, the rest stay where they are
+            source_index = self.sourceModel().index(os.path.join(self.current_path["path"], name))
+            if source_index.isValid():
+                self.row_keys[source_index.internalId()] = (rank, name.lower())
+                self.sourceModel().dataChanged.emit(source_index, source_index)
+
+    def filterAcceptsRow(self, source_row, source_parent):
+        if self.tag_filter is None or source_parent != self.root:
+            return True
 
-        self.last_filter = index
+        name = self.sourceModel().index(source_row, 0, source_parent).data()
+        return self.tag_filter.matches(self.file_states.tagged_in(self.current_path["path"]).get(name, DEFAULT_MASK))
 
 
 class ColorDelegate(QStyledItemDelegate):
+    """Paints the tagged items with the colors of their tag.
+
+    The brush and pen of every tag are built once, and what paint needs of every row of the shown directory (tag, icon
+    and text) is kept in a cache until the directory, the rows of the model or the tags change, so repainting a row
+    that was already painted doesn't build paths, look up the tags or ask the model for the icon. The sizes of the
+    rows are kept the same way, so laying out the view again doesn't measure their texts.
+
+    When the items are grouped by tag, the first row of every group is taller and has the name of the tag on top.
+    """
+
     def __init__(self, selection_model, model, view, current_path, file_states, color_tags, parent=None):
         super().__init__(parent)
         self.selection_model = selection_model
@@ -215,37 +762,153 @@ class ColorDelegate(QStyledItemDelegate):
         self.current_path = current_path
         self.file_states = file_states
         self.color_tags = color_tags
+        self.icon_provider = model.iconProvider()
 
         self.special_item_index = None
 
+        self.tag_brushes = {}  # Tag id -> (brush, pen)
+        self.row_cache = {}  # Row -> (tag, icon, icon width, text), or None if the row isn't tagged
+        self.size_cache = {}  # Row -> size hint
+        self.rows_added = False  # Whether rows were added to the shown folder since the model sorted it
+        self.group_by_tag = False
+        self.header_height = 0
+        self.refresh_colors()
+
+        view_model = self.view.model()
+        view_model.rowsInserted.connect(self.rows_changed)
+        view_model.rowsRemoved.connect(self.rows_changed)
+        view_model.layoutChanged.connect(self.layout_changed)
+        view_model.modelReset.connect(self.invalidate)
+        # QFileSystemModel changes the details of a file in place, but not its name, so its size stays
+        view_model.dataChanged.connect(lambda *args: self.row_cache.clear())
+
     def set_special_item(self, index):
         self.special_item_index = index
 
+    def refresh_colors(self):
+        """Build again the brushes and pens of the tags. It must be called after the color tags change"""
+        self.tag_brushes = {v[3]: (QBrush(QColor(v[1])), QPen(QColor(v[2]))) for v in self.color_tags}
+        self.invalidate()
+
+    def invalidate(self, *args):
+        """Forget the cached rows. It's called when the shown directory or its rows change"""
+        self.row_cache.clear()
+        self.size_cache.clear()
+
+    def forget_icons(self):
+        """Forget the cached rows but not their sizes, the icons that change keep the size of the placeholder"""
+        self.row_cache.clear()
+
+    def rows_changed(self, parent, first, last):
+        # The rows of the folders that are read in the background don't move the shown ones
+        if parent == self.view.rootIndex():
+            self.rows_added = True
+            self.invalidate()
+
+    def layout_changed(self, parents=(), hint=None):
+        # QFileSystemModel sorts all its folders after it adds rows to any, but only the new rows move the others
+        if self.rows_added or self.view.rootIndex() in parents:
+            self.rows_added = False
+            self.invalidate()
+
+    def set_group_by_tag(self, group_by_tag):
+        """Show the name of the tag above the first row of every group. The model must be sorted by tag"""
+        self.group_by_tag = group_by_tag
+        self.header_height = self.view.fontMetrics().height() + HEADER_PADDING
+        self.invalidate()
+
+    def group_header(self, index):
+        """Name of the tag of the group that starts at a row, or None if it doesn't start a group"""
+        if not self.group_by_tag:
+            return None
+        model = self.view.model()
+        rank = model.tag_rank(index)
+        if index.row() > 0 and model.tag_rank(index.sibling(index.row() - 1, 0)) == rank:
+            return None
+        return self.color_tags[rank][0] if rank < len(self.color_tags) else "Other tags"
+
+    def cached_rows(self):
+        """Copy of the cached rows of the shown directory, to give back to restore_rows when it's shown again"""
+        return dict(self.row_cache), dict(self.size_cache)
+
+    def restore_rows(self, rows):
+        self.row_cache.update(rows[0])
+        self.size_cache.update(rows[1])
+
+    def sizeHint(self, option, index):
+        try:
+            return self.size_cache[index.row()]
+        except KeyError:
+            size = super().sizeHint(option, index)
+            if self.group_header(index) is not None:
+                size.setHeight(size.height() + self.header_height)
+            self.size_cache[index.row()] = size
+            return size
+
     def paint(self, painter, option, index):
-        full_path = os.path.join(self.current_path["path"], index.data())
+        if self.group_by_tag:
+            header = self.group_header(index)
+            if header is not None:
+                option = QStyleOptionViewItem(option)
+                self.paint_header(painter, option.rect, header)
+                option.rect = option.rect.adjusted(0, self.header_height, 0, 0)
+
+        try:
+            entry = self.row_cache[index.row()]
+        except KeyError:
+            entry = self.cache_row(index, option)
+
+        if entry is None:
+            super().paint(painter, option, index)
+            return
+
+        tag, icon, icon_width, text = entry
+        brush, pen = self.tag_brushes[tag]
+        rect = option.rect
+
+        painter.save()
+        painter.fillRect(rect, brush)
+        painter.setPen(pen)
+        icon.paint(painter, rect.x(), rect.y(), icon_width, rect.height())
+        painter.drawText(rect.adjusted(icon_width + 5, 0, 0, 0), Qt.AlignLeft | Qt.AlignVCenter, text)
+        painter.restore()
+
+    def paint_header(self, painter, rect, text):
+        rect = rect.adjusted(0, 0, 0, self.header_height - rect.height())
+        painter.save()
+        font = painter.font()
+        font.setBold(True)
+        painter.setFont(font)
+        painter.setPen(self.view.palette().color(QPalette.WindowText))
+        painter.drawText(rect.adjusted(5, 0, 0, -2), Qt.AlignLeft | Qt.AlignBottom, text)
+        painter.drawLine(rect.bottomLeft(), rect.bottomRight())
+        painter.restore()
+
+    def cache_row(self, index, option):
+        text = index.data(Qt.DisplayRole)
+        mask = self.file_states.tagged_in(self.current_path["path"]).get(text)
+        tag = None if mask is None else self.file_states.main_tag(mask)
+        if tag not in self.tag_brushes:
+            entry = None
+        else:
+            icon = self.row_icon(index)
+            entry = (tag, icon, icon.actualSize(option.rect.size()).width(), text)
 
-        if full_path in self.file_states:
-            painter.save()
-            painter.fillRect(option.rect, self.color_tags[self.file_states[full_path]][1])
-            painter.setPen(self.color_tags[self.file_states[full_path]][2])
+        self.row_cache[index.row()] = entry
+        return entry
 
-            icon = self.model.fileIcon(index)
-            rect_width_minus_icon = option.rect.width() - icon.actualSize(option.rect.size()).width()
-            icon_rect = option.rect.adjusted(0, 0, -rect_width_minus_icon, 0)
-            icon.paint(painter, icon_rect)
+    def row_icon(self, index):
+        return self.icon_provider.icon(self.model.fileInfo(self.view.model().mapToSource(index)))
 
-            text_rect = option.rect.adjusted(icon.actualSize(option.rect.size()).width() + 5, 0, 0, 0)
-            painter.drawText(text_rect, Qt.AlignLeft | Qt.AlignVCenter, index.data(Qt.DisplayRole))
-            painter.restore()
-        else:
-            super().paint(painter, option, index)
+    def initStyleOption(self, option, index):
+        # The model keeps the first icon the provider gave, which can be the placeholder of an extension
+        super().initStyleOption(option, index)
+        if option.features & option.HasDecoration:
+            option.icon = self.row_icon(index)
 
     def update_index_value(self, index):
-        full_path = os.path.join(self.current_path["path"], index.data())
-        if full_path not in self.file_states:
-            self.file_states[full_path] = 1
-        else:
-            self.file_states[full_path] = (self.file_states[full_path] + 1) % len(self.color_tags)
+        self.file_states.cycle_tag(os.path.join(self.current_path["path"], index.data()))
+        self.row_cache.pop(index.row(), None)
 
     def editorEvent(self, event, model, option, index):
         if event.type() == QContextMenuEvent.MouseButtonRelease and event.button() == Qt.RightButton:
@@ -0,0 +1,249 @@
+import errno
+import fnmatch
+import os
+import re
+import shutil
+import threading
+import time
+
+from PyQt5.QtCore import QObject, QThreadPool, pyqtSignal
+
+from app.src.worker import Worker
+
+COPY = "copy"
+MOVE = "move"
+DELETE = "delete"
+
+CHUNK_SIZE = 1024 * 1024
+PROGRESS_INTERVAL = 0.1  # Minimum seconds between two progress signals of a job
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class FileJob(Worker):
+    """Copy, move or delete a list of files and directories, recursively, in a worker thread.
+
+    The job only touches the disk. The pairs (source, target) of the items that were copied or moved completely are
+    kept in `results`, so the tags can be updated in one batch in the GUI thread when the job finishes.
+    """
+
+    def __init__(self, kind, paths, destination=None):
+        """
+        Init method
+
+        :param kind: COPY, MOVE or DELETE
+        :param paths: Paths of the items
+        :param destination: Directory where the items are copied or moved
+        """
+        super().__init__()
+        self.kind = kind
+        self.paths = list(paths)
+        self.destination = destination
+
+        self.done = 0
+        self.total = 0
+        self.results = []
+        self.error = None
+        self.cancelled = threading.Event()
+        self._last_progress = 0
+
+    def description(self):
+        verb = {COPY: "Copying", MOVE: "Moving", DELETE: "Deleting"}[self.kind]
+        return f"{verb} {len(self.paths)} item{'s' if len(self.paths) != 1 else ''}"
+
+    def percent(self):
+        return 100 if self.total == 0 else min(100, self.done * 100 // self.total)
+
+    def cancel(self):
+        self.cancelled.set()
+
+    def work(self):
+        try:
+            if self.kind == DELETE:
+                self.total = sum(count_entries(path) for path in self.paths)
+                for path in self.paths:
+                    self.delete_tree(path)
+                    self.results.append((path, None))
+            else:
+                self.total = sum(tree_size(path) for path in self.paths)
+                for path in self.paths:
+                    if self.kind == MOVE and os.path.dirname(path) == self.destination:
+                        continue
+                    if is_inside(self.destination, path):
+                        raise OSError(f"Cannot {self.kind} {path} inside itself")
+                    target = unique_target(os.path.join(self.destination, os.path.basename(path)))
+                    if self.kind == MOVE:
+                        self.move_tree(path, target)
+                    else:
+                        self.copy_item(path, target)
+                    self.results.append((path, target))
+        except JobCancelled:
+            self.error = "cancelled"
+        except OSError as e:
+            self.error = str(e)
+
+    def move_tree(self, source, target):
+        self.check_cancelled()
+        size = tree_size(source)
+        try:
+            os.rename(source, target)
+            self.advance(size)
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+
+            # Different filesystems, copy and delete the source
+            self.copy_item(source, target)
+            if os.path.isdir(source) and not os.path.islink(source):
+                shutil.rmtree(source)
+            else:
+                os.remove(source)
+
+    def copy_item(self, source, target):
+        """Copy a file or a directory with all its content. A cancelled copy removes what was already copied"""
+        try:
+            if os.path.isdir(source) and not os.path.islink(source):
+                self.copy_dir(source, target)
+            else:
+                self.copy_file(source, target)
+        except JobCancelled:
+            if os.path.isdir(target) and not os.path.islink(target):
+                shutil.rmtree(target, ignore_errors=True)
+            elif os.path.lexists(target):
+                os.remove(target)
+            raise
+
+    def copy_dir(self, source, target):
+        os.mkdir(target)
+        with os.scandir(source) as it:
+            for entry in it:
+                if entry.is_dir(follow_symlinks=False):
+                    self.copy_dir(entry.path, os.path.join(target, entry.name))
+                else:
+                    self.copy_file(entry.path, os.path.join(target, entry.name))
+        shutil.copystat(source, target)
+
+    def copy_file(self, source, target):
+        if os.path.islink(source):
+            os.symlink(os.readlink(source), target)
+            return
+
+        with open(source, "rb") as src, open(target, "wb") as dst:
+            while True:
+                self.check_cancelled()
+                chunk = src.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                dst.write(chunk)
+                self.advance(len(chunk))
+        shutil.copystat(source, target)
+
+    def delete_tree(self, path):
+        self.check_cancelled()
+        if os.path.isdir(path) and not os.path.islink(path):
+            with os.scandir(path) as it:
+                for entry in it:
+                    self.delete_tree(entry.path)
+            os.rmdir(path)
+        else:
+            os.remove(path)
+        self.advance(1)
+
+    def check_cancelled(self):
+        if self.cancelled.is_set():
+            raise JobCancelled()
+
+    def advance(self, amount):
+        self.done += amount
+        now = time.monotonic()
+        if now - self._last_progress >= PROGRESS_INTERVAL:
+            self._last_progress = now
+            self.signals.progress.emit(self)
+
+
+class FileOperationQueue(QObject):
+    """Runs the file jobs in a thread pool and forwards their signals"""
+    progress = pyqtSignal(object)
+    finished = pyqtSignal(object)
+
+    def __init__(self, max_threads=2, parent=None):
+        super().__init__(parent)
+        self.pool = QThreadPool(self)
+        self.pool.setMaxThreadCount(max_threads)
+        self.jobs = []
+
+    def submit(self, job):
+        self.jobs.append(job)
+        job.signals.progress.connect(self.progress)
+        job.signals.finished.connect(self.on_job_finished)
+        self.pool.start(job)
+
+    def cancel_all(self):
+        for job in self.jobs:
+            job.cancel()
+
+    def on_job_finished(self, job):
+        self.jobs.remove(job)
+        self.finished.emit(job)
+
+
+def tree_size(path):
+    """Number of bytes of a file, or of all the files inside a directory"""
+    if os.path.isdir(path) and not os.path.islink(path):
+        total = 0
+        with os.scandir(path) as it:
+            for entry in it:
+                total += tree_size(entry.path) if entry.is_dir(follow_symlinks=False) else \
+                    entry.stat(follow_symlinks=False).st_size
+        return total
+    return os.lstat(path).st_size
+
+
+def count_entries(path):
+    """Number of files and directories of a tree, the root included"""
+    if os.path.isdir(path) and not os.path.islink(path):
+        with os.scandir(path) as it:
+            return 1 + sum(count_entries(entry.path) for entry in it)
+    return 1
+
+
+def is_inside(path, directory):
+    """Whether path is directory or any path under it"""
+    path = os.path.abspath(path)
+    directory = os.path.abspath(directory)
+    return path == directory or path.startswith(directory.rstrip(os.sep) + os.sep)
+
+
+def unique_target(path):
+    """Add a number to the name if the path already exists, the same way file managers name copies"""
+    if not os.path.lexists(path):
+        return path
+
+    root, ext = os.path.splitext(path)
+    n = 1
+    while os.path.lexists(f"{root} ({n}){ext}"):
+        n += 1
+    return f"{root} ({n}){ext}"
+
+
+def name_matcher(pattern, regex=False):
+    """Function that tells whether a name matches a glob pattern, or contains a regular expression
+
+    :raises re.error: If the regular expression isn't valid
+    """
+    compiled = re.compile(pattern if regex else fnmatch.translate(pattern))
+    return compiled.search if regex else compiled.match
+
+
+def find_matching(directory, matches, recursive=False):
+    """Paths of the items of a directory whose names match, and of the items of all its subdirectories if recursive.
+    Symbolic links to directories aren't followed
+    """
+    paths = []
+    for root, dirs, files in os.walk(directory):
+        paths.extend(os.path.join(root, name) for name in dirs + files if matches(name))
+        if not recursive:
+            break
+    return paths
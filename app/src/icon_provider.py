@@ -0,0 +1,124 @@
+from collections import OrderedDict
+
+from PyQt5.QtCore import QFileInfo, QMimeDatabase, QObject, QThreadPool, QTimer, pyqtSignal
+from PyQt5.QtGui import QIcon
+from PyQt5.QtWidgets import QFileIconProvider
+
+from app.src.worker import Worker
+
+MAX_CACHED_ICONS = 256
+READY_DELAY = 50  # Milliseconds the resolved icons are gathered before the views are told
+
+
+class ProviderSignals(QObject):
+    """Signals of a CachedIconProvider, which isn't a QObject"""
+    icons_ready = pyqtSignal()
+
+
+class ResolveJob(Worker):
+    """Find in a worker thread the MIME type of some extensions, from the name of a file of each one, and the names of
+    their theme icons
+    """
+
+    def __init__(self, names):
+        """
+        :param names: {extension: name of a file with that extension}
+        """
+        super().__init__()
+        self.names = names
+        self.results = {}  # Extension -> (icon name, generic icon name)
+
+    def work(self):
+        mime_db = QMimeDatabase()
+        for key, name in self.names.items():
+            mime_type = mime_db.mimeTypeForFile(name, QMimeDatabase.MatchExtension)
+            self.results[key] = (mime_type.iconName(), mime_type.genericIconName())
+
+
+class CachedIconProvider(QFileIconProvider):
+    """Icons of the files by their extension, found in a worker thread and kept in an LRU cache.
+
+    The default provider finds the MIME type and the theme icon of every file on the GUI thread, even when a directory
+    has thousands of files of a few types. Here an extension that isn't in the cache gets the generic file icon at
+    once, and its MIME type is looked up from the name only, without reading the file, in a worker thread. When it's
+    there, `icons_ready` tells the views to paint the rows again. QFileSystemModel keeps the first icon it gets for
+    every file, so the views must ask the provider for the icons of the rows they paint.
+    """
+
+    def __init__(self, max_icons=MAX_CACHED_ICONS):
+        super().__init__()
+        self.signals = ProviderSignals()
+        self.icons_ready = self.signals.icons_ready
+        self.max_icons = max_icons
+
+        # The icons of the folders and of the files without an extension are kept out of the cache, so they're never
+        # evicted. Without an extension the type could only be known by reading the file
+        self.file_icon = super().icon(QFileIconProvider.File)
+        self.folder_icon = super().icon(QFileIconProvider.Folder)
+        self.icons = OrderedDict()  # Extension -> QIcon, the least recently used first
+        self.hits = 0
+        self.misses = 0
+
+        self.pool = QThreadPool()
+        self.pool.setMaxThreadCount(1)
+        self.jobs = []
+        self.queued = {}  # Extension -> name of a file, to resolve in the next job
+        self.pending = set()  # Extensions queued or being resolved
+        self.queue_timer = QTimer()
+        self.queue_timer.setSingleShot(True)
+        self.queue_timer.timeout.connect(self.resolve_queued)
+        self.ready_timer = QTimer()
+        self.ready_timer.setSingleShot(True)
+        self.ready_timer.timeout.connect(self.icons_ready.emit)
+
+    def icon(self, arg):
+        if not isinstance(arg, QFileInfo):
+            return super().icon(arg)
+
+        if arg.isDir():
+            self.hits += 1
+            return self.folder_icon
+        key = arg.suffix().lower()
+        if not key:
+            self.hits += 1
+            return self.file_icon
+        icon = self.icons.get(key)
+        if icon is not None:
+            self.icons.move_to_end(key)
+            self.hits += 1
+            return icon
+
+        self.misses += 1
+        if key not in self.pending:
+            self.pending.add(key)
+            self.queued[key] = arg.fileName()
+            self.queue_timer.start(0)
+        return self.file_icon
+
+    def resolve_queued(self):
+        names, self.queued = self.queued, {}
+        job = ResolveJob(names)
+        job.signals.finished.connect(self.resolved)
+        self.jobs.append(job)
+        self.pool.start(job)
+
+    def resolved(self, job):
+        self.jobs.remove(job)
+        for key, (icon_name, generic_icon_name) in job.results.items():
+            self.pending.discard(key)
+            icon = QIcon.fromTheme(icon_name, QIcon.fromTheme(generic_icon_name))
+            self.icons[key] = self.file_icon if icon.isNull() else icon
+        while len(self.icons) > self.max_icons:
+            self.icons.popitem(last=False)
+        if not self.ready_timer.isActive():
+            self.ready_timer.start(READY_DELAY)
+
+    def stop(self):
+        self.queue_timer.stop()
+        self.ready_timer.stop()
+        self.pool.waitForDone()
+
+    def hit_rate(self):
+        """Fraction of the icons that were found in the cache, or None if none was asked yet"""
+        total = self.hits + self.misses
+        return self.hits / total if total else None
@@ -0,0 +1,111 @@
+import os
+from collections import OrderedDict
+
+from PyQt5.QtCore import QObject, QTimer
+
+from app.src.tag_store import in_tree
+
+MAX_CACHED_FOLDERS = 32
+PREFETCH_DELAY = 150  # Milliseconds the cursor must stay on a folder before it's read
+
+
+class NavigationCache(QObject):
+    """Remembers how the recently visited folders were shown, and reads in the background the folders that are likely
+    to be opened next.
+
+    For every folder it keeps the filter and the order it was shown with, the item at the top of the view and the rows
+    that the delegate had already prepared, so going back to it shows the same place without looking up any tag. The
+    rows are forgotten when the tags or the items of the folder change, and they're used only with the same filter and
+    order. The parent of the shown folder and the folder under the cursor are loaded into the model and their tags are
+    decoded before they're opened, so entering them doesn't start from nothing.
+    """
+
+    def __init__(self, file_states, file_model, max_folders=MAX_CACHED_FOLDERS, parent=None):
+        super().__init__(parent)
+        self.file_states = file_states
+        self.file_model = file_model
+        self.max_folders = max_folders
+
+        self.states = OrderedDict()  # Folder -> [(filter, order), name of the top item, rows of the delegate or None]
+        self.queued = []  # Folders to read when the timer fires
+        self.under_cursor = None  # Folder under the cursor, it's replaced when the cursor moves
+        self.prefetch_timer = QTimer(self)
+        self.prefetch_timer.setSingleShot(True)
+        self.prefetch_timer.timeout.connect(self.prefetch_next)
+
+        self.file_states.listeners.append(self.path_changed)
+        self.file_states.tree_listeners.append(self.tree_changed)
+        self.file_model.rowsInserted.connect(self.rows_changed)
+        self.file_model.rowsRemoved.connect(self.rows_changed)
+        self.file_model.modelReset.connect(self.forget_rows)
+
+    def save(self, folder, view, top_name, rows):
+        """Keep the state of a folder that is going to be left, forgetting the least recently visited one if there are
+        too many
+        """
+        self.states[folder] = [view, top_name, rows]
+        self.states.move_to_end(folder)
+        while len(self.states) > self.max_folders:
+            self.states.popitem(last=False)
+
+    def restore(self, folder, view):
+        """State of a folder that is going to be shown with a (filter, order)
+
+        :return: (name of the top item, rows of the delegate or None if it must be prepared again), or None if the
+        folder wasn't visited recently
+        """
+        state = self.states.get(folder)
+        if state is None:
+            return None
+        self.states.move_to_end(folder)
+        return state[1], (state[2] if state[0] == view else None)
+
+    def forget_rows(self, folder=None):
+        """Forget the prepared rows of a folder, or of all of them. It must be called when the colors or the icons
+        change
+        """
+        for path, state in self.states.items():
+            if folder is None or path == folder:
+                state[2] = None
+
+    def path_changed(self, path, mask):
+        self.forget_rows(None if path is None else os.path.dirname(path))
+
+    def tree_changed(self, op, source, target):
+        roots = (source, target) if op == "move" else (target,)
+        for path, state in self.states.items():
+            if any(path == os.path.dirname(root) or in_tree(path, root) for root in roots):
+                state[2] = None
+
+    def rows_changed(self, parent, first, last):
+        if parent.isValid():
+            self.forget_rows(self.file_model.filePath(parent))
+
+    def prefetch(self, folder, under_cursor=False):
+        """Read a folder in the background after a moment. The folder under the cursor isn't read if the cursor moves
+        to another one before
+        """
+        if under_cursor:
+            self.under_cursor = folder
+        elif folder not in self.queued:
+            self.queued.append(folder)
+        self.prefetch_timer.start(PREFETCH_DELAY)
+
+    def prefetch_next(self):
+        folders, self.queued = self.queued, []
+        if self.under_cursor is not None:
+            folders.append(self.under_cursor)
+            self.under_cursor = None
+        for folder in folders:
+            if not os.path.isdir(folder):
+                continue
+            index = self.file_model.index(folder)
+            # The model reads the directory in its own thread
+            if self.file_model.canFetchMore(index):
+                self.file_model.fetchMore(index)
+            self.file_states.open_directory(folder)
+
+    def stop(self):
+        self.prefetch_timer.stop()
+        self.file_states.listeners.remove(self.path_changed)
+        self.file_states.tree_listeners.remove(self.tree_changed)
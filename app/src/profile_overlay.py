@@ -0,0 +1,58 @@
+import time
+from collections import deque
+
+from PyQt5.QtCore import QEvent, QTimer
+from PyQt5.QtWidgets import QApplication, QLabel
+
+from app.src.profiling import profiler
+
+REFRESH_INTERVAL = 500  # Milliseconds between two updates of the overlay
+FPS_WINDOW = 1.0  # Seconds of frames that are counted for the frame rate
+SHOWN_EVENTS = ("populate", "filter", "paint", "save")
+
+
+class ProfileOverlay(QLabel):
+    """Label of the status bar with the last duration of the probed operations, the frame rate of the view and the
+    fraction of the icons that were in the cache of the icon provider.
+
+    It also times the frames of the view: a paint event of the viewport is sent again to it from the event filter,
+    so the whole frame, with every row the delegate paints, is one event.
+    """
+
+    def __init__(self, viewport, icon_provider=None, parent=None):
+        super().__init__(parent)
+        self.viewport = viewport
+        self.icon_provider = icon_provider
+        self.painting = False
+        self.frames = deque()  # Start time of the frames of the last FPS_WINDOW seconds
+        viewport.installEventFilter(self)
+
+        self.timer = QTimer(self)
+        self.timer.timeout.connect(self.refresh)
+        self.timer.start(REFRESH_INTERVAL)
+        self.refresh()
+
+    def eventFilter(self, obj, event):
+        if obj is not self.viewport or event.type() != QEvent.Paint or self.painting:
+            return False
+
+        self.painting = True
+        self.frames.append(time.perf_counter())
+        try:
+            with profiler.span("paint"):
+                QApplication.sendEvent(obj, event)
+        finally:
+            self.painting = False
+        return True
+
+    def refresh(self):
+        last = profiler.last
+        parts = [f"{name} {last[name] * 1000:.1f} ms" for name in SHOWN_EVENTS if name in last]
+        since = time.perf_counter() - FPS_WINDOW
+        while self.frames and self.frames[0] < since:
+            self.frames.popleft()
+        parts.append(f"{len(self.frames) / FPS_WINDOW:.0f} fps")
+        hit_rate = self.icon_provider.hit_rate() if self.icon_provider is not None else None
+        if hit_rate is not None:
+            parts.append(f"icons {hit_rate * 100:.1f}% cached")
+        self.setText(" | ".join(parts))
@@ -0,0 +1,81 @@
+import json
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager, nullcontext
+from functools import wraps
+
+"""
+Timing probes of the slow paths: loading and saving the tags, populating a directory, filtering and painting.
+
+They're enabled with the environment variable COLOR_TAGS_PROFILE. With "1" the explorer shows the last times in the
+status bar, and with a path it also writes there the trace of the session, in the Chrome trace format that
+chrome://tracing and https://ui.perfetto.dev open. When it isn't set, probe returns the functions as they are and span
+returns a shared context manager that does nothing, so the probes cost nothing.
+"""
+
+PROFILE = os.environ.get("COLOR_TAGS_PROFILE", "")
+ENABLED = bool(PROFILE)
+TRACE_FILE = PROFILE if PROFILE not in ("", "1") else None
+MAX_EVENTS = 200000  # The oldest events are dropped after this many
+
+NULL_SPAN = nullcontext()
+
+
+class Profiler:
+    """Keeps the timed events, and the last duration of every kind of event"""
+
+    def __init__(self):
+        self.origin = time.perf_counter()
+        self.events = deque(maxlen=MAX_EVENTS)  # (name, start, duration, thread id)
+        self.last = {}  # Name -> duration of its last event
+        self.lock = threading.Lock()
+
+    def record(self, name, start, duration):
+        with self.lock:
+            self.events.append((name, start, duration, threading.get_ident()))
+            self.last[name] = duration
+
+    @contextmanager
+    def span(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, start, time.perf_counter() - start)
+
+    def export_trace(self, path):
+        """Write the events in the Chrome trace format"""
+        with self.lock:
+            events = list(self.events)
+        pid = os.getpid()
+        trace = {"traceEvents": [{"name": name, "cat": "explorer", "ph": "X", "pid": pid, "tid": tid,
+                                  "ts": round((start - self.origin) * 1e6, 1), "dur": round(duration * 1e6, 1)}
+                                 for name, start, duration, tid in events],
+                 "displayTimeUnit": "ms"}
+        with open(path, "w") as f:
+            json.dump(trace, f)
+
+
+profiler = Profiler()
+
+
+def span(name):
+    """Context manager that times its block as an event"""
+    return profiler.span(name) if ENABLED else NULL_SPAN
+
+
+def probe(name):
+    """Decorator that times every call of a function as an event"""
+
+    def decorator(function):
+        if not ENABLED:
+            return function
+
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            with profiler.span(name):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
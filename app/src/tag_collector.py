@@ -0,0 +1,52 @@
+from PyQt5.QtCore import QObject, QTimer, pyqtSignal
+
+TICK_INTERVAL = 200  # Milliseconds between two steps of a pass
+TICK_BUDGET = 0.01  # Seconds a step may take
+PASS_INTERVAL = 10 * 60 * 1000  # Milliseconds between two passes
+
+
+class TagCollector(QObject):
+    """Removes, little by little while the explorer is idle, the tags of the paths that don't exist anymore.
+
+    Every step visits the directories of the store in order until its time budget is spent, and the next step goes on
+    from there, so a pass over a big database never blocks the window for long. The directories that are being
+    watched are skipped, because their items may be in the middle of a rename.
+    """
+    pass_finished = pyqtSignal(int)  # Number of tags removed in the pass
+
+    def __init__(self, file_states, exclude=(), parent=None):
+        """
+        Init method
+
+        :param file_states: TagStore
+        :param exclude: Container of the directories that aren't visited
+        """
+        super().__init__(parent)
+        self.file_states = file_states
+        self.exclude = exclude
+
+        self.cursor = None
+        self.reclaimed = 0
+        self.timer = QTimer(self)
+        self.timer.timeout.connect(self.step)
+        self.pass_timer = QTimer(self)
+        self.pass_timer.setSingleShot(True)
+        self.pass_timer.timeout.connect(self.start)
+
+    def start(self):
+        """Start a pass"""
+        self.cursor = None
+        self.reclaimed = 0
+        self.timer.start(TICK_INTERVAL)
+
+    def stop(self):
+        self.timer.stop()
+        self.pass_timer.stop()
+
+    def step(self):
+        self.cursor, reclaimed = self.file_states.collect_garbage(self.cursor, TICK_BUDGET, self.exclude)
+        self.reclaimed += reclaimed
+        if self.cursor is None:
+            self.timer.stop()
+            self.pass_finished.emit(self.reclaimed)
+            self.pass_timer.start(PASS_INTERVAL)
@@ -0,0 +1,178 @@
+import re
+
+"""
+Filter expressions over the tags of the paths. A path matches when every clause separated by commas is true, and the
+clauses combine names of tags with NOT, AND, OR and parentheses, in that order of precedence:
+
+    urgent OR special, NOT normal
+    "urgent tag" AND NOT (special OR 3)
+
+A tag is given by its name, by a unique beginning of its name, or by its id. The keywords are case-insensitive.
+"""
+
+TOKEN = re.compile(r'\s*(?:(\()|(\))|(,)|"([^"]*)"|([^\s(),"]+))')
+KEYWORDS = ("AND", "OR", "NOT")
+
+
+class FilterError(ValueError):
+    pass
+
+
+class TagFilter:
+    """A compiled filter expression.
+
+    The tags of a path are a bit mask, and a directory usually has only a few different masks, so the expression is
+    evaluated once per mask and the result is kept. Filtering the names of a directory is then a lookup per name.
+    """
+
+    def __init__(self, text, test):
+        self.text = text
+        self._test = test
+        self._results = {}  # Mask -> whether it matches
+
+    @classmethod
+    def parse(cls, text, color_tags):
+        """Compile a filter expression
+
+        :param text: The expression
+        :param color_tags: Color tags of the store, to find the tags by name
+        :raises FilterError: If the expression isn't valid or a tag doesn't exist
+        """
+        return cls(text, Parser(text, color_tags).parse())
+
+    @classmethod
+    def for_tag(cls, tag, name=None):
+        """Filter of the paths that have one tag"""
+        return cls(name if name is not None else str(tag), lambda mask: mask >> tag & 1)
+
+    def matches(self, mask):
+        result = self._results.get(mask)
+        if result is None:
+            result = self._results[mask] = bool(self._test(mask))
+        return result
+
+    def prepare(self, masks):
+        """Evaluate at once all the different masks of a directory, so matches doesn't evaluate anything"""
+        for mask in set(masks).difference(self._results):
+            self._results[mask] = bool(self._test(mask))
+
+    def __eq__(self, other):
+        return isinstance(other, TagFilter) and self.text == other.text
+
+    def __hash__(self):
+        return hash(self.text)
+
+
+class Parser:
+    """Recursive descent parser of the filter expressions. Every rule returns a function of the mask of a path"""
+
+    def __init__(self, text, color_tags):
+        self.text = text
+        self.color_tags = color_tags
+        self.tokens = tokenize(text)
+        self.position = 0
+
+    def parse(self):
+        if not self.tokens:
+            raise FilterError("Empty filter")
+        test = self.clauses()
+        if self.position < len(self.tokens):
+            raise FilterError(f"Unexpected {self.tokens[self.position][1]!r}")
+        return test
+
+    def clauses(self):
+        tests = [self.disjunction()]
+        while self.accept(","):
+            tests.append(self.disjunction())
+        return tests[0] if len(tests) == 1 else lambda mask: all(test(mask) for test in tests)
+
+    def disjunction(self):
+        tests = [self.conjunction()]
+        while self.accept("OR"):
+            tests.append(self.conjunction())
+        return tests[0] if len(tests) == 1 else lambda mask: any(test(mask) for test in tests)
+
+    def conjunction(self):
+        tests = [self.negation()]
+        while self.accept("AND"):
+            tests.append(self.negation())
+        return tests[0] if len(tests) == 1 else lambda mask: all(test(mask) for test in tests)
+
+    def negation(self):
+        if self.accept("NOT"):
+            test = self.negation()
+            return lambda mask: not test(mask)
+        return self.atom()
+
+    def atom(self):
+        if self.accept("("):
+            test = self.clauses()
+            if not self.accept(")"):
+                raise FilterError("Missing )")
+            return test
+
+        # A name is every word until the next keyword or symbol, so names with spaces don't need quotes
+        words = []
+        while self.position < len(self.tokens) and self.tokens[self.position][0] in ("word", "name"):
+            kind, value = self.tokens[self.position]
+            if kind == "word" and value.upper() in KEYWORDS:
+                break
+            words.append(value)
+            self.position += 1
+            if kind == "name":
+                break
+        if not words:
+            if self.position == len(self.tokens):
+                raise FilterError("Missing a tag at the end")
+            raise FilterError(f"Expected a tag before {self.tokens[self.position][1]!r}")
+
+        tag = find_tag(" ".join(words), self.color_tags)
+        return lambda mask: mask >> tag & 1
+
+    def accept(self, symbol):
+        if self.position < len(self.tokens):
+            kind, value = self.tokens[self.position]
+            if (kind == "symbol" and value == symbol) or (kind == "word" and value.upper() == symbol):
+                self.position += 1
+                return True
+        return False
+
+
+def find_tag(name, color_tags):
+    """Id of a tag given by its name, by a unique beginning of its name, or by its id. Case-insensitive
+
+    :raises FilterError: If there isn't such tag, or there are several
+    """
+    key = name.casefold()
+    for v in color_tags:
+        if v[0].casefold() == key:
+            return v[3]
+    if name.isdigit() and any(v[3] == int(name) for v in color_tags):
+        return int(name)
+
+    found = [v for v in color_tags if v[0].casefold().startswith(key)]
+    if len(found) == 1:
+        return found[0][3]
+    if found:
+        raise FilterError(f"{name!r} can be any of: {', '.join(v[0] for v in found)}")
+    raise FilterError(f"Unknown tag: {name}")
+
+
+def tokenize(text):
+    """List of (kind, value) with kind "symbol", "word" or "name" for the quoted names"""
+    tokens = []
+    position = 0
+    text = text.strip()
+    while position < len(text):
+        match = TOKEN.match(text, position)
+        if match is None:
+            raise FilterError(f"Unexpected {text[position:]!r}")
+        opening, closing, comma, quoted, word = match.groups()
+        if quoted is not None:
+            tokens.append(("name", quoted))
+        elif word is not None:
+            tokens.append(("word", word))
+        else:
+            tokens.append(("symbol", opening or closing or comma))
+        position = match.end()
+    return tokens
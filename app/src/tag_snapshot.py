@@ -0,0 +1,214 @@
+import json
+import mmap
+import os
+import struct
+import sys
+from array import array
+
+"""
+Binary snapshot of the tag store.
+
+The file has a header, the color tags as JSON, one section per directory with its tagged names and their tags, the
+paths of the directories and an index sorted by directory. The file is memory-mapped: opening it only reads the
+header and the color tags, and the tags of a directory can be read with a binary search in the index without
+parsing the rest of the file.
+
+    header    magic, version, number of directories, generation, number of paths, offsets of the other parts
+    tags      color tags as JSON
+    sections  names of a directory separated by NUL, then their tag masks as little-endian uint64 (bit n is tag id n)
+    strings   paths of the directories
+    index     one record per directory, sorted by path: path offset and length, section offset, names length, count,
+              and the mask of all the tags of its names
+
+A snapshot can also be updated by appending the sections that changed, new strings and a new index, and rewriting
+the header last. Until the header is written, the old one still points to a complete snapshot.
+
+The generation is increased every time the snapshot is written. The journal of the store starts with the generation
+of the snapshot it applies to, so a journal that was already folded into the snapshot is recognized. Older snapshots
+have a generation of 0.
+
+Snapshots of version 1 have a single tag id per name, as uint16. They're read as masks of one tag. The index of the
+snapshots of version 1 and 2 doesn't have the tags of the directories, they're read as if they had every tag.
+"""
+
+MAGIC = b"CTAG"
+VERSION = 3
+MASK_SIZES = {1: 2, 2: 8, 3: 8}  # Bytes of the tags of a name in every version
+ALL_TAGS = (1 << 64) - 1
+HEADER = struct.Struct("<4sIIIQQQQQ")
+RECORD = struct.Struct("<QIQIIQ")
+OLD_RECORD = struct.Struct("<QIQII")  # Versions 1 and 2
+ENCODING = "utf-8"
+ERRORS = "surrogatepass"  # Paths that aren't valid UTF-8 are kept as they are
+
+
+class SnapshotError(Exception):
+    pass
+
+
+class Snapshot:
+    """Read-only view of a binary snapshot"""
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) if os.fstat(f.fileno()).st_size else b""
+
+        if len(self.mm) < HEADER.size:
+            raise SnapshotError(f"{path} is not a tag snapshot")
+        magic, self.version, self.dir_count, self.generation, self.path_count, tags_offset, tags_length, \
+            self.strings_offset, self.index_offset = HEADER.unpack_from(self.mm, 0)
+        if magic != MAGIC or self.version not in MASK_SIZES:
+            raise SnapshotError(f"{path} is not a tag snapshot of version {VERSION} or older")
+        self.mask_size = MASK_SIZES[self.version]
+        self.record_struct = RECORD if self.version > 2 else OLD_RECORD
+
+        self.color_tags = [tuple(v) for v in json.loads(self.mm[tags_offset:tags_offset + tags_length])]
+
+    def close(self):
+        if isinstance(self.mm, mmap.mmap):
+            self.mm.close()
+
+    def record(self, i):
+        """Directory and (section offset, names length, count, tags) of the i-th record of the index"""
+        record = self.record_struct.unpack_from(self.mm, self.index_offset + i * self.record_struct.size)
+        start = self.strings_offset + record[0]
+        directory = self.mm[start:start + record[1]].decode(ENCODING, ERRORS)
+        return directory, record[2:] if self.version > 2 else (*record[2:], ALL_TAGS)
+
+    def find(self, directory):
+        """Binary search of a directory in the index, without loading it
+
+        :return: The location of its section, or None if the directory doesn't have tagged names
+        """
+        i = self.bisect(directory)
+        if i < self.dir_count:
+            current, location = self.record(i)
+            if current == directory:
+                return location
+        return None
+
+    def find_range(self, start, end):
+        """Every (directory, location) of the index with start <= directory < end, found with binary searches"""
+        return [self.record(i) for i in range(self.bisect(start), self.bisect(end))]
+
+    def bisect(self, directory):
+        """Position of the first record of the index that isn't before a directory"""
+        low, high = 0, self.dir_count
+        while low < high:
+            middle = (low + high) // 2
+            if self.record(middle)[0] < directory:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def index(self):
+        """Every (directory, location) of the index, sorted by directory"""
+        strings = self.mm[self.strings_offset:self.index_offset]
+        records = self.mm[self.index_offset:self.index_offset + self.dir_count * self.record_struct.size]
+        if self.version > 2:
+            for path_offset, path_length, section_offset, names_length, count, tags in RECORD.iter_unpack(records):
+                yield (strings[path_offset:path_offset + path_length].decode(ENCODING, ERRORS),
+                       (section_offset, names_length, count, tags))
+        else:
+            for path_offset, path_length, section_offset, names_length, count in OLD_RECORD.iter_unpack(records):
+                yield (strings[path_offset:path_offset + path_length].decode(ENCODING, ERRORS),
+                       (section_offset, names_length, count, ALL_TAGS))
+
+    def section(self, location):
+        """Names and tags of a directory
+
+        :return: (names, masks) with the names sorted and the masks as array("Q")
+        """
+        offset, names_length, count, _ = location
+        names = self.mm[offset:offset + names_length].decode(ENCODING, ERRORS).split("\0")
+        masks = array("Q" if self.version > 1 else "H")
+        masks.frombytes(self.mm[offset + names_length:offset + names_length + self.mask_size * count])
+        if sys.byteorder != "little":
+            masks.byteswap()
+        if self.version == 1:
+            masks = array("Q", (1 << tag for tag in masks))
+        return names, masks
+
+    def section_size(self, location):
+        return location[1] + self.mask_size * location[2]
+
+    def raw_section(self, location):
+        """Section of a directory as it's in the file, to copy it to another snapshot of the same version
+
+        :return: (raw section, names length, count, tags), the way write_snapshot takes it
+        """
+        offset, names_length, count, tags = location
+        return self.mm[offset:offset + self.section_size(location)], names_length, count, tags
+
+
+def write_snapshot(path, color_tags, sections, append=False, generation=0):
+    """Write a binary snapshot. A new one is written to a temporary path and then moved over the old one by the caller,
+    who may have to close the old one first
+
+    :param path: Path where the snapshot is written
+    :param color_tags: Color tags of the store
+    :param sections: Iterable of (directory, data) sorted by directory. data is the DirTags of the directory, a
+    (raw section, names length, count, tags) tuple to copy a section of another snapshot without decoding it, or when
+    appending, the location of a section that is already in the file
+    :param append: Whether to update the snapshot in path in place, writing only the new sections
+    :param generation: Generation of the snapshot
+    :return: Location of the section of every directory, in the same order
+    """
+    locations = []
+    strings = bytearray()
+    index = bytearray()
+    path_count = 0
+
+    with open(path, "r+b" if append else "wb") as f:
+        if append:
+            f.seek(0, os.SEEK_END)
+        else:
+            f.write(b"\0" * HEADER.size)
+        tags_data = json.dumps(color_tags).encode(ENCODING)
+        tags_offset = f.tell()
+        f.write(tags_data)
+
+        for directory, data in sections:
+            offset = f.tell()
+            if isinstance(data, tuple) and isinstance(data[0], int):
+                offset, names_length, count, tags = data
+            elif isinstance(data, tuple):
+                raw, names_length, count, tags = data
+                f.write(raw)
+            else:
+                names_data = "\0".join(data).encode(ENCODING, ERRORS)
+                masks = array("Q", data.masks)
+                if sys.byteorder != "little":
+                    masks.byteswap()
+                f.write(names_data)
+                f.write(masks.tobytes())
+                names_length, count = len(names_data), len(data)
+                tags = 0
+                for mask in set(data.masks):
+                    tags |= mask
+
+            location = (offset, names_length, count, tags)
+            locations.append(location)
+            path_count += count
+
+            directory_data = directory.encode(ENCODING, ERRORS)
+            index += RECORD.pack(len(strings), len(directory_data), *location)
+            strings += directory_data
+
+        strings_offset = f.tell()
+        f.write(strings)
+        index_offset = f.tell()
+        f.write(index)
+        # The header goes last, so a crash while appending leaves the old snapshot as it was
+        f.flush()
+        os.fsync(f.fileno())
+
+        f.seek(0)
+        f.write(HEADER.pack(MAGIC, VERSION, len(locations), generation, path_count, tags_offset, len(tags_data),
+                            strings_offset, index_offset))
+        f.flush()
+        os.fsync(f.fileno())
+
+    return locations
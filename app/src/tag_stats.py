@@ -0,0 +1,332 @@
+import os
+import stat
+import threading
+
+from PyQt5.QtCore import QObject, QThreadPool, QTimer, pyqtSignal
+
+from app.src.tag_store import in_tree, mask_tags
+from app.src.worker import Worker
+
+CHUNK_SIZE = 1000  # Paths whose sizes are sent to the GUI thread at once
+CHANGED_DELAY = 200  # Milliseconds the changes are gathered before the views are told
+
+
+def read_size(path):
+    """(size, is dir) of a path, or None if it doesn't exist"""
+    try:
+        st = os.stat(path, follow_symlinks=False)
+    except OSError:
+        return None
+    return st.st_size, stat.S_ISDIR(st.st_mode)
+
+
+class StatJob(Worker):
+    """Read the size of a list of paths in a worker thread, and send them in chunks with `progress` as
+    {path: (size, is dir)}. The paths that don't exist are sent as None
+    """
+
+    def __init__(self, paths):
+        super().__init__()
+        self.paths = paths
+        self.cancelled = threading.Event()
+
+    def cancel(self):
+        self.cancelled.set()
+
+    def work(self):
+        results = {}
+        for path in self.paths:
+            if self.cancelled.is_set():
+                break
+            results[path] = read_size(path)
+            if len(results) >= CHUNK_SIZE:
+                self.signals.progress.emit(results)
+                results = {}
+        if results:
+            self.signals.progress.emit(results)
+
+
+class ScanJob(StatJob):
+    """List the tagged paths of the store in a worker thread and read the sizes of the ones that weren't read before.
+    The paths that were read before are only sent if their tags changed, with the size they had, and the ones that
+    aren't in the store anymore are kept in `vanished` if the job wasn't cancelled
+    """
+
+    def __init__(self, sections, known):
+        """
+        :param sections: TagStore.section_reader()
+        :param known: {directory: {name: (mask, size, is dir)}} of the paths that were read before
+        """
+        super().__init__(())
+        self.sections = sections
+        self.known = known
+        self.vanished = None
+
+    def work(self):
+        try:
+            self.scan()
+        finally:
+            # The mapping of the snapshot is closed even if the job is cancelled
+            self.sections.close()
+
+    def scan(self):
+        results = {}
+        vanished = []
+        known_dirs = set(self.known)
+        for directory, names, masks in self.sections:
+            if self.cancelled.is_set():
+                return
+            known = self.known.get(directory, {})
+            known_dirs.discard(directory)
+            for name, mask in zip(names, masks):
+                entry = known.get(name)
+                path = os.path.join(directory, name)
+                if entry is None:
+                    results[path] = read_size(path)
+                elif entry[0] != mask:
+                    results[path] = entry[1:]
+                if len(results) >= CHUNK_SIZE:
+                    self.signals.progress.emit(results)
+                    results = {}
+            if known:
+                vanished.extend(os.path.join(directory, name) for name in known.keys() - set(names))
+        for directory in known_dirs:
+            vanished.extend(os.path.join(directory, name) for name in self.known[directory])
+        if results:
+            self.signals.progress.emit(results)
+        self.vanished = vanished
+
+
+class TagStats(QObject):
+    """Number of files and folders of every tag, and the size of the files, for all the store and for any folder.
+
+    Listing the tagged paths and reading their sizes is slow, so it's done once in a worker thread when the numbers
+    are first needed. After that the store tells every change of a path, and only that path is updated: a change of
+    its tags moves its counts from the old tags to the new ones without touching the disk, and only a new path is read
+    in the worker. When the store is loaded again because another process compacted it, the paths are listed again in
+    the worker and only the new and changed ones are updated. The numbers are kept per folder of the store, so the
+    ones under a folder are the sum of its subfolders, and a moved or copied tree takes the numbers of its folders
+    along. Paths that don't exist aren't counted, and sizes that change on disk are read again with `start`.
+    """
+    changed = pyqtSignal()
+
+    def __init__(self, file_states, parent=None):
+        super().__init__(parent)
+        self.file_states = file_states
+
+        self.entries = {}  # Directory -> {name: (mask, size, is dir)} of the paths that were read
+        self.dir_totals = {}  # Directory -> {tag: [files, folders, size]} of the paths directly inside it
+        self.totals = {}  # Tag -> [files, folders, size] of all the store
+        self.pending = set()  # Tagged paths whose sizes are being read
+        self.scanning = None  # ScanJob listing the paths of the store
+        self.started = False
+
+        self.pool = QThreadPool(self)
+        self.pool.setMaxThreadCount(1)
+        self.jobs = []
+        self.queued = []  # New paths that go to the worker in the next job
+        self.queue_timer = QTimer(self)
+        self.queue_timer.setSingleShot(True)
+        self.queue_timer.timeout.connect(self.read_queued)
+        self.changed_timer = QTimer(self)
+        self.changed_timer.setSingleShot(True)
+        self.changed_timer.timeout.connect(self.changed.emit)
+
+    def start(self):
+        """Read again the sizes of all the tagged paths, and follow the changes of the store from now on"""
+        self.stop()
+        if not self.started:
+            self.file_states.listeners.append(self.path_changed)
+            self.file_states.tree_listeners.append(self.tree_changed)
+            self.started = True
+
+        self.entries = {}
+        self.dir_totals = {}
+        self.totals = {}
+        self.pending = set()
+        self.scan()
+        self.changed_timer.start(0)
+
+    def scan(self):
+        """List the tagged paths in the worker, and read the sizes of the ones that weren't read before"""
+        known = {directory: dict(names) for directory, names in self.entries.items()}
+        self.scanning = ScanJob(self.file_states.section_reader(), known)
+        self.submit(self.scanning)
+
+    def stop(self):
+        """Cancel the reads in progress, and wait for the worker"""
+        self.cancel()
+        self.pool.waitForDone()
+        self.jobs = []
+
+    def cancel(self):
+        for job in self.jobs:
+            job.cancel()
+        self.scanning = None
+        self.queued = []
+        self.queue_timer.stop()
+
+    def close(self):
+        self.stop()
+        if self.started:
+            self.file_states.listeners.remove(self.path_changed)
+            self.file_states.tree_listeners.remove(self.tree_changed)
+            self.started = False
+
+    def is_reading(self):
+        return bool(self.pending) or self.scanning is not None
+
+    def totals_under(self, root):
+        """{tag: [files, folders, size]} of the paths inside root and all its subfolders"""
+        totals = {}
+        dirs = self.file_states.dirs_under(root)
+        dirs.append(root)
+        for directory in dirs:
+            for tag, values in self.dir_totals.get(directory, {}).items():
+                total = totals.setdefault(tag, [0, 0, 0])
+                for i, value in enumerate(values):
+                    total[i] += value
+        return totals
+
+    def path_changed(self, path, mask):
+        if path is None:
+            # All the tags were loaded again, mostly the same ones after another process compacted them, so only what
+            # changed is read again. The running jobs aren't waited for, their results are checked against the store
+            self.cancel()
+            self.pending = set()
+            self.scan()
+            return
+
+        directory, name = os.path.split(path)
+        names = self.entries.get(directory)
+        entry = names.pop(name, None) if names is not None else None
+        if entry is not None:
+            self.count(directory, *entry, -1)
+            if mask:
+                names[name] = (mask, entry[1], entry[2])
+                self.count(directory, mask, entry[1], entry[2], 1)
+            elif not names:
+                del self.entries[directory]
+                del self.dir_totals[directory]
+            self.notify()
+        elif not mask:
+            self.pending.discard(path)
+        elif path not in self.pending:
+            self.pending.add(path)
+            self.queued.append(path)
+            self.queue_timer.start(0)
+
+    def tree_changed(self, op, source, target):
+        """Move or copy the entries of a tree to their new paths. The sizes don't change, so nothing is read again,
+        and the numbers of every folder go to its new path as they are
+        """
+        move = op == "move"
+        parent, name = os.path.split(source)
+        entry = self.entries.get(parent, {}).get(name)
+        if entry is not None:
+            if move:
+                self.remove_entry(parent, name)
+            self.set_entry(*os.path.split(target), entry)
+
+        # The folders of the tree are the ones of the store under target now
+        for new_directory in [target] + self.file_states.dirs_under(target):
+            directory = source + new_directory[len(target):]
+            if directory not in self.entries:
+                continue
+            if new_directory not in self.entries:
+                if move:
+                    self.entries[new_directory] = self.entries.pop(directory)
+                    self.dir_totals[new_directory] = self.dir_totals.pop(directory)
+                    continue
+                self.entries[new_directory] = dict(self.entries[directory])
+                dir_totals = self.dir_totals[new_directory] = {}
+                for tag, values in self.dir_totals[directory].items():
+                    dir_totals[tag] = list(values)
+                    total = self.totals.setdefault(tag, [0, 0, 0])
+                    for i, value in enumerate(values):
+                        total[i] += value
+                continue
+            # A folder merged with one that already has entries replaces the tags of the names they have in common
+            for name, entry in list(self.entries[directory].items()):
+                if move:
+                    self.remove_entry(directory, name)
+                self.set_entry(new_directory, name, entry)
+
+        # The paths that are being read are read again at their new place
+        for path in [path for path in self.pending if in_tree(path, source)]:
+            new_path = target + path[len(source):]
+            if move:
+                self.pending.remove(path)
+            if new_path not in self.pending:
+                self.pending.add(new_path)
+                self.queued.append(new_path)
+                self.queue_timer.start(0)
+        self.notify()
+
+    def set_entry(self, directory, name, entry):
+        self.remove_entry(directory, name)
+        self.entries.setdefault(directory, {})[name] = entry
+        self.count(directory, *entry, 1)
+
+    def remove_entry(self, directory, name):
+        names = self.entries.get(directory)
+        entry = names.pop(name, None) if names is not None else None
+        if entry is None:
+            return
+        self.count(directory, *entry, -1)
+        if not names:
+            del self.entries[directory]
+            del self.dir_totals[directory]
+
+    def read_queued(self):
+        paths, self.queued = self.queued, []
+        if paths:
+            self.submit(StatJob(paths))
+
+    def submit(self, job):
+        job.signals.progress.connect(self.add_results)
+        job.signals.finished.connect(self.job_finished)
+        self.jobs.append(job)
+        self.pool.start(job)
+
+    def add_results(self, results):
+        for path, result in results.items():
+            self.pending.discard(path)
+            # The tags are the current ones, not the ones the path had when it was sent to the worker, and a path
+            # whose tags were removed meanwhile isn't counted. A path read twice replaces its entry
+            mask = self.file_states.get_mask(path)
+            if result is not None and mask:
+                self.set_entry(*os.path.split(path), (mask, *result))
+        self.notify()
+
+    def job_finished(self, job):
+        if job in self.jobs:
+            self.jobs.remove(job)
+        if job is self.scanning:
+            self.scanning = None
+            for path in job.vanished:
+                if self.file_states.get_mask(path) is None:
+                    self.remove_entry(*os.path.split(path))
+            self.notify()
+
+    def notify(self):
+        # The views are told at most once every CHANGED_DELAY, even while the worker sends results all the time
+        if not self.changed_timer.isActive():
+            self.changed_timer.start(CHANGED_DELAY)
+
+    def count(self, directory, mask, size, is_dir, sign):
+        dir_totals = self.dir_totals.setdefault(directory, {})
+        for tag in mask_tags(mask):
+            for totals in (self.totals, dir_totals):
+                values = totals.setdefault(tag, [0, 0, 0])
+                values[1 if is_dir else 0] += sign
+                if not is_dir:
+                    values[2] += sign * size
+
+
+def format_size(size):
+    for unit in ("bytes", "KiB", "MiB", "GiB"):
+        if size < 1024:
+            return f"{size:.0f} {unit}" if unit == "bytes" else f"{size:.1f} {unit}"
+        size /= 1024
+    return f"{size:.1f} TiB"
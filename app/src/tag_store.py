@@ -0,0 +1,1263 @@
+import json
+import os
+import time
+from array import array
+from bisect import bisect_left, bisect_right, insort
+from collections import Counter, OrderedDict
+from collections.abc import MutableMapping
+from contextlib import contextmanager
+from functools import wraps
+from itertools import chain
+
+try:
+    import fcntl
+except ImportError:  # Windows, the journal isn't locked
+    fcntl = None
+
+from app.src.profiling import probe
+from app.src.tag_snapshot import VERSION, Snapshot, write_snapshot
+
+JOURNAL_SUFFIX = ".journal"
+LOCK_SUFFIX = ".lock"
+SNAPSHOT_EXTENSION = ".tags"
+MIN_SNAPSHOT_GARBAGE = 1 << 20  # Bytes of old sections a snapshot can have before it's rewritten
+SMALL_DIRECTORY = 8  # Names of a directory whose masks are kept in a tuple instead of an array
+
+# Color tags are (name, base color, text color, id). The files store the id, so the tags can be reordered, renamed
+# or recolored without touching the file states. The first tag is the one of the untagged files and its id is always 0
+DEFAULT_TAG_ID = 0
+# A path can have several tags, stored as a mask where the bit n is the tag with id n
+DEFAULT_MASK = 1 << DEFAULT_TAG_ID
+MAX_TAGS = 64
+DEFAULT_COLOR_TAGS = [("normal tag", "#ffffff", "#000000", 0),
+                      ("special tag", "#ffff00", "#000000", 1),
+                      ("urgent tag", "#ff0000", "#ffffff", 2)]
+
+
+def normalize_color_tags(color_tags):
+    """Color tags with their ids. Metadata files of older versions don't have ids and their file states are the
+    positions of the tags, so the position is used as id
+    """
+    return [tuple(v) if len(v) > 3 else (v[0], v[1], v[2], k) for k, v in enumerate(color_tags)]
+
+
+def new_tag_id(color_tags):
+    """Id for a new color tag, the lowest that isn't used. The ids of the deleted tags were removed from the files
+
+    :raises ValueError: If there are already MAX_TAGS tags
+    """
+    used = {v[3] for v in color_tags}
+    for tag in range(MAX_TAGS):
+        if tag not in used:
+            return tag
+    raise ValueError(f"There can't be more than {MAX_TAGS} tags")
+
+
+def tag_mask(tags):
+    mask = 0
+    for tag in tags:
+        mask |= 1 << tag
+    return mask
+
+
+def mask_tags(mask):
+    """Ids of the tags of a mask, in order of id"""
+    return [tag for tag in range(mask.bit_length()) if mask >> tag & 1]
+
+
+def json_tags(mask):
+    """Tags of a mask as they're written in the JSON metadata file: an id, or a list if there are several"""
+    tags = mask_tags(mask)
+    return tags[0] if len(tags) == 1 else json.dumps(tags)
+
+
+def file_id(path):
+    """Inode, size and modification time of a file, which change when it's written or replaced, or None if it doesn't
+    exist
+    """
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    return stat.st_ino, stat.st_size, stat.st_mtime_ns
+
+
+# Directories whose subdirectories are where removable drives and shares are mounted
+MOUNT_PARENTS = ("/mnt", "/media", "/run/media", "/Volumes")
+
+
+def mount_targets():
+    """Directories where the filesystems of /etc/fstab are mounted, mounted or not"""
+    targets = set()
+    try:
+        with open("/etc/fstab") as f:
+            for line in f:
+                fields = line.split()
+                if len(fields) > 1 and not fields[0].startswith("#"):
+                    targets.add(fields[1].replace("\\040", " "))
+    except OSError:
+        pass
+    return targets
+
+
+def unmounted(path, targets):
+    """Whether a drive or a share may be mounted at a path but isn't: the path is in /etc/fstab or under one of
+    MOUNT_PARENTS, possibly in a folder of the user, and isn't a mount point now
+    """
+    parent = os.path.dirname(path)
+    if path not in targets and parent not in MOUNT_PARENTS and os.path.dirname(parent) not in MOUNT_PARENTS:
+        return False
+    return not os.path.ismount(path)
+
+
+def in_tree(path, root):
+    """Whether a path is root or is inside it"""
+    return path == root or path.startswith(root.rstrip(os.sep) + os.sep)
+
+
+def listed_names(directory, targets=None):
+    """Names inside a directory, to remove the tags of the ones that were deleted
+
+    An unmounted drive looks like an empty directory, or like a missing one if the directory where it's mounted is
+    removed on unmount. Not even the device tells it apart from a folder whose items were deleted, it's the one of the
+    parent while nothing is mounted, so only the places where drives are mounted aren't trusted while they're empty.
+
+    :param targets: mount_targets(), if it was already read
+    :return: Set of names, empty if the directory was deleted or emptied. None if the listing can't be trusted: the
+    directory can't be read, or it or one of its missing ancestors may be a drive that isn't mounted
+    """
+    if targets is None:
+        targets = mount_targets()
+    try:
+        with os.scandir(directory) as it:
+            names = {entry.name for entry in it}
+        return None if not names and unmounted(directory, targets) else names
+    except (FileNotFoundError, NotADirectoryError):
+        pass
+    except OSError:
+        return None
+
+    ancestor = directory
+    while not os.path.isdir(ancestor):
+        if os.path.dirname(ancestor) == ancestor or unmounted(ancestor, targets):
+            return None  # A drive letter that isn't there, or a mount point removed on unmount
+        ancestor = os.path.dirname(ancestor)
+    return None if unmounted(ancestor, targets) else set()
+
+
+def locked(method):
+    """Run a method of a TagStore holding the lock of its journal"""
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self._locked():
+            return method(self, *args, **kwargs)
+    return wrapper
+
+
+def batched(method):
+    """Run a method of a TagStore that changes it inside a batch, unless a batch is already open"""
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        if self._pending is not None:
+            return method(self, *args, **kwargs)
+        with self.batch():
+            return method(self, *args, **kwargs)
+    return wrapper
+
+
+class DirTags(list):
+    """Tagged names of one directory. The names are the items of the list, kept sorted, and the masks of their tags
+    are at the same positions in a tuple while the directory is small, and packed in an array when it grows. It takes
+    much less memory than a dictionary, and the different masks of the directory are found with a single set() done
+    in C
+    """
+    __slots__ = ("masks",)
+
+    def __init__(self, names=(), masks=()):
+        super().__init__(names)
+        if len(masks) > SMALL_DIRECTORY:
+            self.masks = masks if isinstance(masks, array) else array("Q", masks)
+        else:
+            # Most directories of a sparse tree have a name or two, where the array would take more than the names
+            self.masks = tuple(masks)
+
+    def get(self, name, default=None):
+        """Mask of the tags of a name"""
+        i = bisect_left(self, name)
+        if i < len(self) and self[i] == name:
+            return self.masks[i]
+        return default
+
+    def set(self, name, mask):
+        """Set the mask of the tags of a name
+
+        :return: The previous mask, or None if the name didn't have one
+        """
+        masks = self.masks
+        i = bisect_left(self, name)
+        if i < len(self) and self[i] == name:
+            old_mask = masks[i]
+            if isinstance(masks, tuple):
+                self.masks = masks[:i] + (mask,) + masks[i + 1:]
+            else:
+                masks[i] = mask
+            return old_mask
+        self.insert(i, name)
+        if isinstance(masks, tuple) and len(masks) < SMALL_DIRECTORY:
+            self.masks = masks[:i] + (mask,) + masks[i:]
+        else:
+            if isinstance(masks, tuple):
+                masks = self.masks = array("Q", masks)
+            masks.insert(i, mask)
+        return None
+
+    def pop(self, name):
+        i = bisect_left(self, name)
+        if i == len(self) or self[i] != name:
+            raise KeyError(name)
+        del self[i]
+        masks = self.masks
+        if isinstance(masks, tuple):
+            self.masks = masks[:i] + masks[i + 1:]
+            return masks[i]
+        return masks.pop(i)
+
+    def items(self):
+        return zip(self, self.masks)
+
+    def names_with_tag(self, tag):
+        bit = 1 << tag
+        if not any(mask & bit for mask in set(self.masks)):
+            return []
+        return [name for name, mask in zip(self, self.masks) if mask & bit]
+
+    def __contains__(self, name):
+        i = bisect_left(self, name)
+        return i < len(self) and self[i] == name
+
+    # Two directories are never equal just because they have the same names
+    __eq__ = object.__eq__
+    __ne__ = object.__ne__
+    __hash__ = object.__hash__
+
+
+EMPTY_DIR_TAGS = DirTags()
+
+
+class TagStore(MutableMapping):
+    """Persistent mapping of file paths to tag ids.
+
+    The metadata file keeps the last compacted state and every change done after that is appended as a JSON line to
+    a journal next to it, so a change costs a small append instead of rewriting the whole metadata file. When the
+    journal grows past a threshold it's folded back into the metadata file.
+
+    The compacted state is a binary snapshot (see tag_snapshot) next to the JSON metadata file, which is only read
+    when there isn't a snapshot yet. The snapshot is memory-mapped and loads lazily: right after opening it, the tags
+    of a directory are found with a binary search in its index, and the index is only parsed by ensure_index, which
+    every operation over the whole store calls. The sections of the directories are decoded the first time they're
+    used.
+
+    The tags of a path are a mask of tag ids, and the tag of a path, as a mapping, is its main tag: the first of its
+    tags in the display order, which gives its color.
+
+    The paths aren't kept as full strings. Every parent directory is stored once, as the key of the DirTags of the
+    names inside it, so the repeated prefixes of a big database don't take memory and the tags of a directory are
+    found with a single lookup. The directories are also kept in a sorted list, where all the directories under a
+    path are next to each other, so a subtree is found with two binary searches instead of visiting every key.
+
+    Every directory is a shard. The decoded directories that didn't change are kept in an LRU cache and, when it's
+    over its budget, the oldest ones go back to being a location in the snapshot. The changed ones stay decoded until
+    they're written, and a compaction only appends them to the snapshot with a new index, so saving costs the
+    directories that changed and not the whole database. The snapshot is rewritten when the old sections take more
+    space than the live ones.
+
+    Several processes can use the same metadata file at once. Every change is done inside a batch, which holds an
+    exclusive lock on a file next to the journal and first applies the records that other processes appended since the
+    journal was last read, so the changes of a process go on top of the others' and only its own records are written.
+    sync() reads only the new end of the journal, and when another process compacted it, the snapshot is opened
+    again. Compactions are done under the same lock, and the journal is emptied in place instead of removed, because
+    the other processes keep it open.
+    """
+
+    def __init__(self, meta_file: str = "meta.json", compact_threshold: int = 50000, cache_size: int = 200000):
+        """
+        Init method
+
+        :param meta_file: Path of the JSON metadata file. Old metadata files written by `json.dump` are loaded as
+        they are, and the snapshot is written with the same name and the extension ".tags"
+        :param compact_threshold: Number of journal records after which the journal is folded into the snapshot
+        :param cache_size: Number of names of the decoded directories without changes that are kept in memory
+        """
+        self.meta_file = meta_file
+        self.snapshot_file = os.path.splitext(meta_file)[0] + SNAPSHOT_EXTENSION
+        self.journal_file = meta_file + JOURNAL_SUFFIX
+        self.lock_file = meta_file + LOCK_SUFFIX
+        self.compact_threshold = compact_threshold
+        self.cache_size = cache_size
+
+        self.color_tags = list(DEFAULT_COLOR_TAGS)
+        self._dirs = {}  # Parent directory -> DirTags, or location of its section in the snapshot
+        self._count = 0
+        self._sorted_dirs = []  # Keys of _dirs in order. None until the index is parsed
+        self._snapshot = None
+        self._indexed = True  # False until the index of the snapshot is parsed
+        self._overlay = {}  # Directory -> journal changes of its names, while the index isn't parsed
+        self._cache = OrderedDict()  # Decoded directories without changes -> location, the oldest used first
+        self._cached_names = 0
+        self._journal_fd = None
+        self._journal_records = 0
+        self._journal_offset = 0  # Bytes of the journal already applied, if none the generation is written first
+        self._snapshot_id = None  # file_id of the snapshot when it was opened
+        self._lock_fd = None
+        self._lock_depth = 0  # Nested blocks holding the lock
+        self._generation = 0  # Generation of the snapshot, 0 if there isn't a snapshot
+        self._pending = None  # List of records while a batch is open
+        self._main_tags = {}  # Mask -> main tag, for the current display order
+        self.listeners = []  # Functions called with (path, mask) after every change, the mask is 0 if it's removed
+        # Functions called with (op, source, target) after a tree is moved or copied, its paths aren't told one by one
+        self.tree_listeners = []
+
+        self.load()
+
+    def __getitem__(self, path):
+        tag = self.get(path)
+        if tag is None:
+            raise KeyError(path)
+        return tag
+
+    def __setitem__(self, path, tag):
+        """Give a path a single tag"""
+        self.set_mask(path, 1 << tag)
+
+    @batched
+    def __delitem__(self, path):
+        self.ensure_index()
+        if path not in self:
+            raise KeyError(path)
+        self._remove(path)
+        self._write({"op": "del", "path": path})
+        self._notify(path, 0)
+
+    def __contains__(self, path):
+        directory, name = os.path.split(path)
+        return name in self.tagged_in(directory)
+
+    def __iter__(self):
+        self.ensure_index()
+        for directory in list(self._dirs):
+            for name in list(self._peek(directory)):
+                yield os.path.join(directory, name)
+
+    def __len__(self):
+        self.ensure_index()
+        return self._count
+
+    def get(self, path, default=None):
+        """Main tag of a path"""
+        mask = self.get_mask(path)
+        return default if mask is None else self.main_tag(mask)
+
+    def get_mask(self, path, default=None):
+        directory, name = os.path.split(path)
+        return self.tagged_in(directory).get(name, default)
+
+    @batched
+    def set_mask(self, path, mask):
+        """Set all the tags of a path at once. An empty mask removes the path"""
+        if not mask:
+            if path in self:
+                del self[path]
+            return
+        self.ensure_index()
+        self._set(path, mask)
+        self._write({"op": "set", "path": path, "mask": mask})
+        self._notify(path, mask)
+
+    def tags_of(self, path):
+        """Ids of the tags of a path, in display order"""
+        mask = self.get_mask(path, 0)
+        return [v[3] for v in self.color_tags if mask >> v[3] & 1]
+
+    def main_tag(self, mask):
+        """Id of the first tag of a mask in display order"""
+        tag = self._main_tags.get(mask)
+        if tag is None:
+            tag = next((v[3] for v in self.color_tags if mask >> v[3] & 1), None)
+            if tag is None:
+                tag = (mask & -mask).bit_length() - 1
+            self._main_tags[mask] = tag
+        return tag
+
+    def tagged_in(self, directory):
+        """Tagged names directly inside a directory
+
+        :param directory: Path of the directory, the same way it's joined to build the keys
+        :return: DirTags of the directory. It must not be modified
+        """
+        return self._resolve(directory) or EMPTY_DIR_TAGS
+
+    def open_directory(self, directory):
+        """Decode the tags of a directory that is going to be shown, and move it to the end of the cache"""
+        self._resolve(directory)
+        if directory in self._cache:
+            self._cache.move_to_end(directory)
+
+    def names_with_tag(self, directory, tag):
+        """Names directly inside a directory that have a given tag"""
+        return self.tagged_in(directory).names_with_tag(tag)
+
+    def delete_tag(self, tag):
+        """Remove a tag from all the files that have it. The files without other tags are removed"""
+        self.remove_tag(self.paths_with_tag(tag), tag)
+
+    def paths_with_tag(self, tag):
+        """All the paths that have a given tag. The index of the snapshot has the tags of every directory, so only the
+        sections of the directories with the tag are decoded
+        """
+        self.ensure_index()
+        bit = 1 << tag
+        paths = []
+        for directory, names in self._dirs.items():
+            if isinstance(names, tuple):
+                if not names[3] & bit:
+                    continue
+                names = self._read_section(names)
+            paths.extend(os.path.join(directory, name) for name in names.names_with_tag(tag))
+        return paths
+
+    def dirs_under(self, root):
+        """Directories with tagged names that are under root, root excluded, in order. Until the index is parsed,
+        they're found with a binary search in the index of the snapshot and decoded
+        """
+        if self._indexed:
+            start, end = self._dirs_range(root)
+            return self._sorted_dirs[start:end]
+
+        prefix = root.rstrip(os.sep) + os.sep
+        end = prefix[:-1] + chr(ord(prefix[-1]) + 1)
+        dirs = {directory for directory, _ in self._open_snapshot().find_range(prefix, end)}
+        dirs.update(directory for directory in chain(self._dirs, self._overlay) if prefix <= directory < end)
+        dirs.discard(prefix)
+        return [directory for directory in sorted(dirs) if self._resolve(directory)]
+
+    def paths_matching(self, tag_filter, root=None):
+        """Generator of the tagged paths that match a filter, of all the store or of root and what's under it
+
+        :param tag_filter: TagFilter
+        """
+        if root is None:
+            self.ensure_index()
+            dirs = list(self._sorted_dirs)
+        else:
+            dirs = self.dirs_under(root)
+            if self.tagged_in(root):
+                dirs.insert(0, root)
+
+        for directory in dirs:
+            names = self._peek(directory)
+            tag_filter.prepare(names.masks)
+            for name, mask in list(names.items()):
+                if tag_filter.matches(mask):
+                    yield os.path.join(directory, name)
+
+    def find_under(self, root, tag):
+        """Generator of every path under root with the tag, found in the indexes without touching the disk
+
+        :param root: Directory where the search starts, its own tag isn't checked
+        :param tag: Id of the tag
+        """
+        dirs = self.dirs_under(root)
+        if self.tagged_in(root):
+            dirs.insert(0, root)
+
+        # The names are copied so the store can change while the generator is paused
+        for directory in dirs:
+            for name in self.names_with_tag(directory, tag):
+                yield os.path.join(directory, name)
+
+    def tree_items(self, root):
+        """Tagged paths of root and of everything under it, as (path, mask) pairs"""
+        items = []
+        if root in self:
+            items.append((root, self.get_mask(root)))
+        dirs = self.dirs_under(root)
+        if self.tagged_in(root):
+            dirs.append(root)
+        for directory in dirs:
+            items.extend((os.path.join(directory, name), tag) for name, tag in self._peek(directory).items())
+        return items
+
+    def move_tree(self, source, target):
+        """Move the tags of source and of everything under it to target, with a single journal record. The
+        directories under source are moved as a whole to their new keys, without visiting their names
+
+        :raises ValueError: If target is inside source
+        """
+        self._write_tree("move", source, target)
+
+    def copy_tree(self, source, target):
+        """Copy the tags of source and of everything under it to target, with a single journal record. The
+        directories that weren't decoded are copied as references to their sections in the snapshot
+
+        :raises ValueError: If target is inside source
+        """
+        self._write_tree("copy", source, target)
+
+    def remove_tree(self, root):
+        """Remove the tags of root and of everything under it, in a single journal write"""
+        with self.batch():
+            for path, _ in self.tree_items(root):
+                del self[path]
+
+    def collect_garbage(self, cursor=None, time_budget=0.01, exclude=()):
+        """Remove the tags of the paths that don't exist anymore. The directories are visited in order and listed once
+        each, and the work stops when the time budget is spent, so a pass over a big database is done in many calls.
+        A directory that was deleted loses all its tags, but the ones that can't be read and the ones that may be on a
+        drive that isn't mounted are skipped (see listed_names)
+
+        :param cursor: Directory where the last call stopped, or None to start a pass
+        :param time_budget: Seconds the call may take, at least one directory is visited
+        :param exclude: Directories that aren't visited
+        :return: (cursor, reclaimed) with the cursor for the next call, None when the pass is done, and the number of
+        tags removed
+        """
+        self.ensure_index()
+        deadline = time.perf_counter() + time_budget
+        targets = mount_targets()
+        i = 0 if cursor is None else bisect_right(self._sorted_dirs, cursor)
+        dead = []
+        while i < len(self._sorted_dirs):
+            directory = self._sorted_dirs[i]
+            i += 1
+            if directory in exclude:
+                continue
+
+            existing = listed_names(directory, targets)
+            if existing is None:
+                continue
+            dead.extend(os.path.join(directory, name) for name in self._peek(directory) if name not in existing)
+            if time.perf_counter() >= deadline:
+                break
+
+        cursor = self._sorted_dirs[i - 1] if i < len(self._sorted_dirs) else None
+        self.untag_paths(dead)
+        return cursor, len(dead)
+
+    @batched
+    def set_color_tags(self, color_tags):
+        """Replace the color tags
+
+        :param color_tags: List of (name, base color, text color, id) tuples in display order, colors as "#rrggbb"
+        strings
+        """
+        self.color_tags = [tuple(v) for v in color_tags]
+        self._main_tags = {}
+        self._write({"op": "tags", "tags": self.color_tags})
+
+    def color_tag(self, key):
+        """Find a color tag by id or by name
+
+        :param key: Id of the tag, or its name. A string of digits is taken as an id
+        :return: The (name, base color, text color, id) tuple, or None if there isn't such tag
+        """
+        if isinstance(key, str) and key.isdigit():
+            key = int(key)
+        for v in self.color_tags:
+            if (isinstance(key, int) and v[3] == key) or v[0] == key:
+                return v
+        return None
+
+    @batched
+    def cycle_tag(self, path):
+        """Replace the main tag of a path with the tag that follows it in display order, skipping the tags the path
+        already has. Its other tags are kept, and untagged paths get the second tag
+
+        :return: Id of the new main tag
+        """
+        order = [v[3] for v in self.color_tags]
+        mask = self.get_mask(path, 0)
+        tag = self.main_tag(mask) if mask else None
+        if tag not in order:
+            self.set_mask(path, mask | 1 << order[1 % len(order)])
+            return self[path]
+
+        others = mask & ~(1 << tag)
+        position = order.index(tag)
+        for offset in range(1, len(order)):
+            new_tag = order[(position + offset) % len(order)]
+            if not others >> new_tag & 1:
+                self.set_mask(path, others | 1 << new_tag)
+                break
+        return self[path]
+
+    def tag_paths(self, paths, tag):
+        """Give a tag to several paths in a single journal write"""
+        with self.batch():
+            for path in paths:
+                self[path] = tag
+
+    def untag_paths(self, paths):
+        """Remove all the tags of several paths in a single journal write. Untagged paths are ignored"""
+        with self.batch():
+            for path in paths:
+                if path in self:
+                    del self[path]
+
+    def set_masks(self, masks):
+        """Set the tags of several paths in a single journal write
+
+        :param masks: {path: mask}, an empty mask removes the path
+        :return: {path: previous mask, 0 if it had no tags} of the paths that changed. Setting them undoes the change
+        """
+        previous = {}
+        with self.batch():
+            for path, mask in masks.items():
+                old_mask = self.get_mask(path, 0)
+                if old_mask != mask:
+                    previous[path] = old_mask
+                    self.set_mask(path, mask)
+        return previous
+
+    def add_tag(self, paths, tag):
+        """Add a tag to several paths, keeping the tags they have, in a single journal write"""
+        with self.batch():
+            for path in paths:
+                self.set_mask(path, self.get_mask(path, 0) | 1 << tag)
+
+    def remove_tag(self, paths, tag):
+        """Remove a tag from several paths, keeping their other tags, in a single journal write"""
+        with self.batch():
+            for path in paths:
+                mask = self.get_mask(path)
+                if mask is not None and mask >> tag & 1:
+                    self.set_mask(path, mask & ~(1 << tag))
+
+    @batched
+    def toggle_tag(self, paths, tag):
+        """Remove a tag from several paths if all of them have it, or add it to all of them
+
+        :return: Whether the tag was added
+        """
+        if all(self.get_mask(path, 0) >> tag & 1 for path in paths):
+            self.remove_tag(paths, tag)
+            return False
+        self.add_tag(paths, tag)
+        return True
+
+    def add_color_tag(self, name, base_color, text_color):
+        """Add a color tag at the end of the display order
+
+        :return: Id of the new tag
+        """
+        tag = new_tag_id(self.color_tags)
+        self.set_color_tags(self.color_tags + [(name, base_color, text_color, tag)])
+        return tag
+
+    def update_color_tag(self, tag, name, base_color, text_color):
+        """Rename or recolor a color tag. The files with the tag aren't touched"""
+        self.set_color_tags([(name, base_color, text_color, tag) if v[3] == tag else v for v in self.color_tags])
+
+    def move_color_tag(self, tag, offset):
+        """Move a color tag in the display order. The first tag can't be moved and no tag can go before it
+
+        :return: Whether the tag was moved
+        """
+        color_tags = list(self.color_tags)
+        position = [v[3] for v in color_tags].index(tag)
+        new_position = position + offset
+        if position == 0 or not 1 <= new_position < len(color_tags):
+            return False
+
+        color_tags.insert(new_position, color_tags.pop(position))
+        self.set_color_tags(color_tags)
+        return True
+
+    def delete_color_tag(self, tag):
+        """Delete a color tag and remove it from the files that have it. The first tag can't be deleted"""
+        if tag == DEFAULT_TAG_ID:
+            return
+        with self.batch():
+            self.delete_tag(tag)
+            self.set_color_tags([v for v in self.color_tags if v[3] != tag])
+
+    def stats(self):
+        """Number of tagged paths, and of the directories that contain them, of every color tag. A path with several
+        tags is counted in every one of them
+
+        :return: List of (color tag, paths, directories) in display order
+        """
+        self.ensure_index()
+        paths = {}
+        dirs = {}
+        for directory in self._dirs:
+            counts = Counter(self._peek(directory).masks)
+            dir_mask = 0
+            for mask, count in counts.items():
+                dir_mask |= mask
+                for tag in mask_tags(mask):
+                    paths[tag] = paths.get(tag, 0) + count
+            for tag in mask_tags(dir_mask):
+                dirs[tag] = dirs.get(tag, 0) + 1
+        return [(v, paths.get(v[3], 0), dirs.get(v[3], 0)) for v in self.color_tags]
+
+    def section_reader(self):
+        """Generator of the (directory, names, masks) of every tagged directory, to be read in a worker thread while
+        the store changes. The decoded directories are copied now, and the others are read from a mapping of the
+        snapshot of its own, which is closed when the generator ends
+        """
+        self.ensure_index()
+        dirs = []
+        # Another process can't replace the snapshot while the mapping is opened
+        with self._locked():
+            stale = file_id(self.snapshot_file) != self._snapshot_id
+            snapshot = None
+            for directory, names in self._dirs.items():
+                if isinstance(names, tuple):
+                    if stale:
+                        # The sections are of the snapshot of before another process compacted it, the next sync
+                        # loads the new one
+                        names = self._read_section(names)
+                    elif snapshot is None:
+                        snapshot = Snapshot(self.snapshot_file)
+                dirs.append((directory, names if isinstance(names, tuple) else DirTags(names, names.masks[:])))
+        return self._read_sections(dirs, snapshot)
+
+    @contextmanager
+    def batch(self):
+        """Group all the changes done inside the block in a single journal write. The journal is locked during the
+        block, and the changes that other processes wrote are applied before it
+        """
+        if self._pending is not None:
+            yield self
+            return
+
+        with self._locked():
+            self.sync()
+            self._pending = []
+            try:
+                yield self
+            finally:
+                records, self._pending = self._pending, None
+                if records:
+                    self._append(records)
+
+    def sync(self):
+        """Apply the changes that other processes wrote since the journal was last read. Only the new records are
+        read, unless another process compacted the journal: then the snapshot is opened again and the listeners are
+        told that all the tags were replaced.
+
+        :return: Whether anything changed
+        """
+        # The sizes are checked without the lock, it's only taken when there is something to read
+        if file_id(self.snapshot_file) == self._snapshot_id and self._journal_size() == self._journal_offset:
+            return False
+
+        with self._locked():
+            if file_id(self.snapshot_file) == self._snapshot_id and self._journal_size() >= self._journal_offset:
+                if self._read_journal(notify=True):
+                    return True
+            self.load()
+            self._notify(None, 0)
+            return True
+
+    @probe("load")
+    @locked
+    def load(self):
+        """Open the snapshot, or load the JSON metadata file if there isn't a snapshot yet, and read the journal.
+
+        The index of the snapshot isn't parsed here, the changes of the journal are kept by directory and applied when
+        the directory is used or when the index is parsed.
+        """
+        self._close_snapshot()
+        self._dirs = {}
+        self._count = 0
+        self._overlay = {}
+        self._clear_cache()
+        self._snapshot_id = file_id(self.snapshot_file)
+        if self._snapshot_id is not None:
+            self._snapshot = Snapshot(self.snapshot_file)
+            self.color_tags = normalize_color_tags(self._snapshot.color_tags)
+            self._main_tags = {}
+            self._indexed = False
+            self._sorted_dirs = None
+            self._generation = self._snapshot.generation
+        else:
+            self._indexed = True
+            self._sorted_dirs = None
+            self._generation = 0
+            if os.path.exists(self.meta_file):
+                self._load_json(self.meta_file)
+
+        self._journal_records = 0
+        self._journal_offset = 0
+        self._read_journal()
+
+        if self._indexed:
+            self._sorted_dirs = sorted(self._dirs)
+
+    @probe("index")
+    def ensure_index(self):
+        """Parse the index of the snapshot and apply the journal to the directories that weren't used yet. It's done
+        once, before the first operation that needs every directory
+        """
+        if self._indexed:
+            return
+
+        # The sections of the directories that were already used are kept, they have their journal changes
+        dirs = dict(self._snapshot.index())
+        dirs.update(self._dirs)
+        for directory, changes in self._overlay.items():
+            location = dirs.get(directory)
+            names = self._read_section(location) if location is not None else DirTags()
+            self._replay(names, changes)
+            dirs[directory] = names
+
+        self._dirs = {k: v for k, v in dirs.items() if v}
+        self._count = sum(v[2] if isinstance(v, tuple) else len(v) for v in self._dirs.values())
+        self._sorted_dirs = sorted(self._dirs)
+        self._overlay = {}
+        self._indexed = True
+
+    @probe("compact")
+    @locked
+    def compact(self):
+        """Write the current state to the snapshot and empty the journal.
+
+        Only the directories that changed are written, appended to the snapshot with a new index. If the old sections
+        take more space than the live ones, the snapshot is written again to a new file and replaced atomically, with
+        the sections that weren't decoded copied as they are. Either way the snapshot gets the next generation, so if
+        the process dies before the journal is emptied, the journal is recognized as already applied and skipped.
+        The changes of the other processes are applied first, so the snapshot has them too.
+        """
+        self.sync()
+        self.ensure_index()
+        snapshot = self._open_snapshot() if os.path.exists(self.snapshot_file) else None
+        # The sections of a snapshot of an older version are decoded and written again
+        upgrade = snapshot is not None and snapshot.version != VERSION
+        sections = []
+        live = 0
+        generation = (self._generation + 1) & 0xFFFFFFFF
+        for directory in self._sorted_dirs:
+            location = None if upgrade else self._location(directory)
+            if location is None:
+                sections.append((directory, self._peek(directory)))
+            else:
+                sections.append((directory, location))
+                live += snapshot.section_size(location)
+
+        if snapshot is not None and not upgrade and \
+                os.path.getsize(self.snapshot_file) - live <= max(live, MIN_SNAPSHOT_GARBAGE):
+            locations = write_snapshot(self.snapshot_file, self.color_tags, sections, append=True,
+                                       generation=generation)
+            self._close_snapshot()
+        else:
+            tmp_file = self.snapshot_file + ".tmp"
+            locations = write_snapshot(tmp_file, self.color_tags,
+                                       ((d, v if isinstance(v, DirTags) else snapshot.raw_section(v))
+                                        for d, v in sections), generation=generation)
+            # The old snapshot can't be replaced while it's mapped on some systems
+            self._close_snapshot()
+            os.replace(tmp_file, self.snapshot_file)
+        self._snapshot = Snapshot(self.snapshot_file)
+        self._snapshot_id = file_id(self.snapshot_file)
+        self._generation = generation
+
+        # Every directory is in the snapshot now, and the decoded ones are kept in the cache
+        self._clear_cache()
+        for directory, location in zip(self._sorted_dirs, locations):
+            if isinstance(self._dirs[directory], tuple):
+                self._dirs[directory] = location
+            else:
+                self._cache_directory(directory, location)
+
+        # Other processes can have the journal open, so it's emptied instead of removed
+        if self._journal_fd is not None:
+            os.ftruncate(self._journal_fd, 0)
+        elif os.path.exists(self.journal_file):
+            os.truncate(self.journal_file, 0)
+        self._journal_records = 0
+        self._journal_offset = 0
+
+    def export_json(self, path):
+        """Write the tags to a JSON metadata file, in the format of the older versions. The paths with several tags
+        have a list of ids instead of an id
+        """
+        self.ensure_index()
+        tmp_file = path + ".tmp"
+        with open(tmp_file, "w") as f:
+            # The states are written one directory at a time instead of building the whole dictionary of full paths
+            f.write('{"file-states": {')
+            separator = ""
+            for directory in self._sorted_dirs:
+                f.write(separator + ", ".join(f"{json.dumps(os.path.join(directory, name))}: {json_tags(mask)}"
+                                              for name, mask in self._peek(directory).items()))
+                separator = ", "
+            f.write(f'}}, "color-tags": {json.dumps(self.color_tags)}}}')
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_file, path)
+
+    @locked
+    def import_json(self, path):
+        """Replace all the tags with the ones of a JSON metadata file, and write them to the snapshot"""
+        # The changes of the other processes are read first, so the compaction doesn't apply them over the new tags
+        self.sync()
+        self.ensure_index()
+        self._dirs = {}
+        self._count = 0
+        self._sorted_dirs = None
+        self._clear_cache()
+        self._load_json(path)
+        self._sorted_dirs = sorted(self._dirs)
+        self.compact()
+        self._notify(None, 0)
+
+    def close(self):
+        """Close the journal and the snapshot. Nothing is rewritten unless the journal is over the compaction threshold
+        or the tags were loaded from a JSON metadata file, which is converted to a snapshot. Another process may have
+        done it already, so the journal is read first
+        """
+        with self._locked():
+            self.sync()
+            if self._journal_records >= self.compact_threshold or \
+                    (self._snapshot is None and os.path.exists(self.meta_file)):
+                self.compact()
+        if self._journal_fd is not None:
+            os.close(self._journal_fd)
+            self._journal_fd = None
+        if self._lock_fd is not None:
+            os.close(self._lock_fd)
+            self._lock_fd = None
+        self._close_snapshot()
+
+    def _load_json(self, path):
+        with open(path, "r") as f:
+            meta_data = json.load(f)
+        for file_path, tags in meta_data["file-states"].items():
+            self._set(file_path, tag_mask(tags) if isinstance(tags, list) else 1 << tags)
+        self.color_tags = normalize_color_tags(meta_data["color-tags"])
+        self._main_tags = {}
+
+    @contextmanager
+    def _locked(self):
+        """Hold the exclusive lock of the journal, so no other process writes it or compacts it meanwhile. Nested
+        blocks share the lock of the outer one
+        """
+        if self._lock_depth == 0 and fcntl is not None:
+            if self._lock_fd is None:
+                self._lock_fd = os.open(self.lock_file, os.O_RDWR | os.O_CREAT, 0o644)
+            fcntl.flock(self._lock_fd, fcntl.LOCK_EX)
+        self._lock_depth += 1
+        try:
+            yield
+        finally:
+            self._lock_depth -= 1
+            if self._lock_depth == 0 and fcntl is not None:
+                fcntl.flock(self._lock_fd, fcntl.LOCK_UN)
+
+    def _journal_size(self):
+        try:
+            return os.path.getsize(self.journal_file)
+        except FileNotFoundError:
+            return 0
+
+    def _read_journal(self, notify=False):
+        """Apply the records of the journal after the part that was already read. It must be locked
+
+        :param notify: Whether the listeners are told about every change, when the records come from other processes
+        :return: False if the journal is of another generation, then it's emptied without applying it
+        """
+        if not os.path.exists(self.journal_file):
+            return True
+        current = True
+        with open(self.journal_file, "rb") as f:
+            f.seek(self._journal_offset)
+            for line in f:
+                # A line without end is a write interrupted by a crash, it's never applied
+                if not line.endswith(b"\n"):
+                    break
+                record = json.loads(line)
+                if self._journal_offset == 0 and record["op"] == "generation":
+                    # A journal of another generation was already folded into the snapshot by a compaction that was
+                    # interrupted before emptying it
+                    if record["value"] != self._generation:
+                        current = False
+                        break
+                elif notify:
+                    self._apply_and_notify(record)
+                    self._journal_records += 1
+                else:
+                    self._apply(record)
+                    self._journal_records += 1
+                self._journal_offset += len(line)
+
+        # Cut the interrupted write, or the journal of another generation, so the next records don't get glued to it
+        if self._journal_offset != self._journal_size():
+            os.truncate(self.journal_file, self._journal_offset)
+        return current
+
+    def _close_snapshot(self):
+        if self._snapshot is not None:
+            self._snapshot.close()
+            self._snapshot = None
+
+    def _open_snapshot(self):
+        # The store can still be used after closing it, the sections that weren't decoded are read again
+        if self._snapshot is None:
+            self._snapshot = Snapshot(self.snapshot_file)
+        return self._snapshot
+
+    def _read_section(self, location):
+        return DirTags(*self._open_snapshot().section(location))
+
+    @staticmethod
+    def _read_sections(dirs, snapshot):
+        try:
+            for directory, names in dirs:
+                yield (directory, *(snapshot.section(names) if isinstance(names, tuple) else (names, names.masks)))
+        finally:
+            if snapshot is not None:
+                snapshot.close()
+
+    def _resolve(self, directory):
+        """DirTags of a directory, decoding its section if needed. None if the directory doesn't have tagged names"""
+        names = self._dirs.get(directory)
+        if isinstance(names, tuple):
+            location = names
+            names = self._dirs[directory] = self._read_section(location)
+            self._cache_directory(directory, location)
+        elif names is None and not self._indexed:
+            # Until the index is parsed, the directory is looked up in the snapshot. The result is kept even if it's
+            # empty so it isn't looked up again, and ensure_index drops the empty ones
+            location = self._open_snapshot().find(directory)
+            names = self._read_section(location) if location is not None else DirTags()
+            changes = self._overlay.pop(directory, ())
+            self._replay(names, changes)
+            self._dirs[directory] = names
+            if location is not None and not changes:
+                self._cache_directory(directory, location)
+        return names
+
+    def _location(self, directory):
+        """Location of a directory in the snapshot, or None if it changed since it was written"""
+        names = self._dirs[directory]
+        return names if isinstance(names, tuple) else self._cache.get(directory)
+
+    def _cache_directory(self, directory, location):
+        self._cache[directory] = location
+        self._cached_names += location[2]
+        # The directory that was just decoded is never evicted, even if it's bigger than the whole cache
+        while self._cached_names > self.cache_size and len(self._cache) > 1:
+            old_directory, old_location = self._cache.popitem(last=False)
+            self._dirs[old_directory] = old_location
+            self._cached_names -= old_location[2]
+
+    def _uncache_directory(self, directory):
+        """Keep a directory decoded because it's going to change"""
+        location = self._cache.pop(directory, None)
+        if location is not None:
+            self._cached_names -= location[2]
+
+    def _clear_cache(self):
+        self._cache = OrderedDict()
+        self._cached_names = 0
+
+    def _peek(self, directory):
+        """DirTags of a directory of the index, without keeping the decoded section"""
+        names = self._dirs[directory]
+        return self._read_section(names) if isinstance(names, tuple) else names
+
+    @staticmethod
+    def _replay(names, changes):
+        for name, mask in changes:
+            if mask is not None:
+                names.set(name, mask)
+            elif name in names:
+                names.pop(name)
+
+    def _set(self, path, mask):
+        directory, name = os.path.split(path)
+        names = self._resolve(directory)
+        self._uncache_directory(directory)
+        if names is None:
+            # Built with its name so the list isn't overallocated, most new directories keep a single name
+            self._dirs[directory] = DirTags((name,), (mask,))
+            self._count += 1
+            if self._sorted_dirs is not None:
+                insort(self._sorted_dirs, directory)
+        elif names.set(name, mask) is None:
+            self._count += 1
+
+    def _remove(self, path):
+        directory, name = os.path.split(path)
+        names = self._resolve(directory)
+        self._uncache_directory(directory)
+        names.pop(name)
+        self._count -= 1
+        # Until the index is parsed, an empty directory is kept so its old section isn't looked up again
+        if not names and self._indexed:
+            del self._dirs[directory]
+            if self._sorted_dirs is not None:
+                del self._sorted_dirs[bisect_left(self._sorted_dirs, directory)]
+
+    def _apply(self, record):
+        op = record["op"]
+        # Journals of older versions set a single tag
+        mask = (record["mask"] if "mask" in record else 1 << record["tag"]) if op == "set" else None
+        if not self._indexed and op in ("set", "del") and os.path.dirname(record["path"]) not in self._dirs:
+            # The directory isn't used yet, the change is applied when it's decoded
+            directory, name = os.path.split(record["path"])
+            self._overlay.setdefault(directory, []).append((name, mask))
+        elif op == "set":
+            self._set(record["path"], mask)
+        elif op == "del":
+            if record["path"] in self:
+                self._remove(record["path"])
+        elif op in ("move", "copy"):
+            self._copy_tree(record["source"], record["target"], op == "move")
+        elif op == "tags":
+            self.color_tags = normalize_color_tags(record["tags"])
+            self._main_tags = {}
+
+    def _apply_and_notify(self, record):
+        op = record["op"]
+        if op in ("move", "copy"):
+            self._apply(record)
+            self._notify_tree(op, record["source"], record["target"])
+        else:
+            self._apply(record)
+            # The records have the whole mask, so the directory isn't decoded to tell it
+            if op == "set":
+                self._notify(record["path"], record["mask"] if "mask" in record else 1 << record["tag"])
+            elif op == "del":
+                self._notify(record["path"], 0)
+
+    def _dirs_range(self, root):
+        """Slice of _sorted_dirs with the directories under root, root excluded"""
+        prefix = root.rstrip(os.sep) + os.sep
+        # Every path that starts with the prefix sorts before the prefix with its last character incremented
+        start = bisect_left(self._sorted_dirs, prefix)
+        end = bisect_left(self._sorted_dirs, prefix[:-1] + chr(ord(prefix[-1]) + 1), start)
+        # The prefix of the filesystem root is the root itself
+        if start < end and self._sorted_dirs[start] == prefix:
+            start += 1
+        return start, end
+
+    @batched
+    def _write_tree(self, op, source, target):
+        source_root = source.rstrip(os.sep) + os.sep
+        if target == source or target.startswith(source_root):
+            raise ValueError(f"Cannot {op} {source} inside itself")
+        self.ensure_index()
+        self._copy_tree(source, target, op == "move")
+        self._write({"op": op, "source": source, "target": target})
+        self._notify_tree(op, source, target)
+
+    def _copy_tree(self, source, target, move):
+        """Copy or move the tags of source and of everything under it to target.
+
+        The directories under source keep their order when source is replaced by target in their paths, so they're
+        taken from the sorted list as one slice and put back in the slice of target. Only the directories that
+        already have tagged names under target are merged name by name.
+        """
+        mask = self.get_mask(source)
+        if mask is not None:
+            if move:
+                self._remove(source)
+            self._set(target, mask)
+
+        if not self._indexed:
+            # Before the index is parsed, only the directories of the tree are decoded, and copied name by name
+            for directory in [source] + self.dirs_under(source):
+                names = self._resolve(directory)
+                new_directory = target + directory[len(source):]
+                for name, mask in list(names.items()):
+                    self._set(os.path.join(new_directory, name), mask)
+                if move and names:
+                    self._uncache_directory(directory)
+                    self._dirs[directory] = DirTags()
+            return
+
+        start, end = self._dirs_range(source)
+        dirs = self._sorted_dirs[start:end]
+        if move:
+            del self._sorted_dirs[start:end]
+        if source in self._dirs:
+            dirs.insert(0, source)
+            if move:
+                del self._sorted_dirs[bisect_left(self._sorted_dirs, source)]
+
+        new_dirs = []
+        for directory in dirs:
+            new_directory = target + directory[len(source):]
+            location = self._location(directory)
+            if move:
+                names = self._dirs.pop(directory)
+                if location is not None and directory in self._cache:
+                    # A decoded directory that didn't change still matches its section in the snapshot
+                    self._uncache_directory(directory)
+            else:
+                # A section of the snapshot can be shared, a decoded directory that changed is copied
+                names = location if location is not None else DirTags(self._dirs[directory],
+                                                                       self._dirs[directory].masks[:])
+
+            if new_directory in self._dirs:
+                target_names = self._resolve(new_directory)
+                self._uncache_directory(new_directory)
+                source_names = self._read_section(names) if isinstance(names, tuple) else names
+                for name, mask in source_names.items():
+                    if target_names.set(name, mask) is None:
+                        self._count += 1
+                if move:
+                    self._count -= len(source_names)
+                continue
+
+            self._dirs[new_directory] = names
+            if not isinstance(names, tuple) and location is not None:
+                self._cache_directory(new_directory, location)
+            if not move:
+                self._count += names[2] if isinstance(names, tuple) else len(names)
+            if new_directory == target:
+                insort(self._sorted_dirs, new_directory)
+            else:
+                new_dirs.append(new_directory)
+
+        if new_dirs:
+            start, end = self._dirs_range(target)
+            self._sorted_dirs[start:end] = sorted(self._sorted_dirs[start:end] + new_dirs) if start != end else new_dirs
+
+    def _notify_tree(self, op, source, target):
+        for listener in self.tree_listeners:
+            listener(op, source, target)
+
+    def _notify(self, path, mask):
+        # A path of None means that all the tags were replaced
+        for listener in self.listeners:
+            listener(path, mask)
+
+    def _write(self, record):
+        if self._pending is not None:
+            self._pending.append(record)
+        else:
+            self._append([record])
+
+    def _append(self, records):
+        if self._journal_fd is None:
+            self._journal_fd = os.open(self.journal_file, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+
+        # All the records of a batch go in a single write to the end of the file. It's locked and was read up to the
+        # end before the batch, so the offset is still the end. A journal of an older version doesn't start with the
+        # generation, the new records go after its own
+        if self._journal_offset == 0:
+            records = [{"op": "generation", "value": self._generation}] + records
+        data = "".join(json.dumps(r) + "\n" for r in records).encode("utf-8")
+        view = memoryview(data)
+        while view:
+            written = os.write(self._journal_fd, view)
+            view = view[written:]
+        os.fsync(self._journal_fd)
+        self._journal_offset += len(data)
+
+        self._journal_records += len(records) - (records[0]["op"] == "generation")
+        if self._journal_records >= self.compact_threshold:
+            self.compact()
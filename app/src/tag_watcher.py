@@ -0,0 +1,149 @@
+import os
+import time
+from collections import OrderedDict
+
+from PyQt5.QtCore import Qt, QFileSystemWatcher, QObject, QTimer, pyqtSignal
+
+MAX_WATCHED_DIRS = 16
+SETTLE_DELAY = 100  # Milliseconds the changes of the directories are gathered before they're read
+GRACE_PERIOD = 2.0  # Seconds an item that disappeared waits for its new name before its tags are removed
+
+
+class TagWatcher(QObject):
+    """Keeps the tags attached to the items of the shown and the recently visited directories when other programs
+    rename, move or delete them.
+
+    QFileSystemWatcher only tells that a directory changed, so the inode of every entry of the watched directories is
+    kept. When an item that has tags, or has tagged items inside, disappears, it waits a moment for a new name with the
+    same inode to appear in any watched directory, and its tags are moved there. If none appears, the item was deleted
+    or moved to a directory that isn't watched, and its tags are removed. An item replaced by another one with the
+    same name, the way editors save files, keeps its tags, even if the new one got the inode of a deleted item.
+    """
+    tags_changed = pyqtSignal()
+
+    def __init__(self, file_states, max_dirs=MAX_WATCHED_DIRS, parent=None):
+        super().__init__(parent)
+        self.file_states = file_states
+        self.max_dirs = max_dirs
+
+        self.watcher = QFileSystemWatcher(self)
+        self.watcher.directoryChanged.connect(self.directory_changed)
+        self.entries = OrderedDict()  # Watched directory -> {name: inode}, the least recently visited first
+        self.changed = set()  # Directories whose changes weren't read yet
+        self.vanished = {}  # Inode -> (path, time) of the tagged items that disappeared
+        self.appeared = {}  # Inode -> (path, time) of the new names
+
+        self.settle_timer = QTimer(self)
+        self.settle_timer.setSingleShot(True)
+        self.settle_timer.timeout.connect(self.read_changes)
+        self.expire_timer = QTimer(self)
+        self.expire_timer.setSingleShot(True)
+        self.expire_timer.setTimerType(Qt.PreciseTimer)
+        self.expire_timer.timeout.connect(self.expire)
+
+    def watch(self, directory):
+        """Watch a directory, forgetting the least recently visited one if there are too many"""
+        if directory in self.entries:
+            self.entries.move_to_end(directory)
+            return
+
+        entries = scan(directory)
+        if entries is None:
+            return
+        self.entries[directory] = entries
+        self.watcher.addPath(directory)
+        while len(self.entries) > self.max_dirs:
+            old_directory, _ = self.entries.popitem(last=False)
+            self.watcher.removePath(old_directory)
+
+    def stop(self):
+        """Stop watching, and forget the changes that weren't read yet"""
+        self.settle_timer.stop()
+        self.expire_timer.stop()
+        if self.entries:
+            self.watcher.removePaths(list(self.entries))
+        self.entries.clear()
+        self.changed.clear()
+
+    def directory_changed(self, directory):
+        # A change usually comes with others, like the two sides of a move, so they're read together
+        self.changed.add(directory)
+        self.settle_timer.start(SETTLE_DELAY)
+
+    def read_changes(self):
+        changed, self.changed = self.changed, set()
+        now = time.monotonic()
+        for directory in changed:
+            old_entries = self.entries.get(directory)
+            if old_entries is None:
+                continue
+
+            entries = scan(directory)
+            if entries is None:
+                # The directory itself is gone, its parent sees where it went if it's watched
+                del self.entries[directory]
+                if directory in self.watcher.directories():
+                    self.watcher.removePath(directory)
+                continue
+            self.entries[directory] = entries
+
+            for name, inode in old_entries.items():
+                if name not in entries and self.has_tags(os.path.join(directory, name)):
+                    self.vanished[inode] = (os.path.join(directory, name), now)
+            # Only new names can be the target of a move, an inode that is reused by a name that already existed isn't
+            for name, inode in entries.items():
+                if name not in old_entries:
+                    self.appeared[inode] = (os.path.join(directory, name), now)
+
+        # The new name may have been read before, with the change of another directory
+        if self.vanished:
+            self.find_moved()
+        if (self.vanished or self.appeared) and not self.expire_timer.isActive():
+            self.expire_timer.start(int(GRACE_PERIOD * 1000))
+
+    def find_moved(self):
+        """Move the tags of the items that disappeared to the new names that have their inodes"""
+        moved = []
+        for inode in list(self.vanished):
+            if inode in self.appeared and os.path.lexists(self.appeared[inode][0]):
+                moved.append((self.vanished.pop(inode)[0], self.appeared.pop(inode)[0]))
+        if not moved:
+            return
+
+        with self.file_states.batch():
+            for source, target in moved:
+                self.file_states.move_tree(source, target)
+        self.tags_changed.emit()
+
+    def expire(self):
+        """Remove the tags of the items that didn't appear anywhere during the grace period"""
+        now = time.monotonic()
+        self.appeared = {k: v for k, v in self.appeared.items() if now - v[1] < GRACE_PERIOD}
+        expired = [(inode, path) for inode, (path, when) in self.vanished.items() if now - when >= GRACE_PERIOD]
+        for inode, _ in expired:
+            del self.vanished[inode]
+        if self.vanished or self.appeared:
+            oldest = min(when for _, when in list(self.vanished.values()) + list(self.appeared.values()))
+            self.expire_timer.start(max(0, int((oldest + GRACE_PERIOD - now) * 1000)) + 1)
+
+        # If something with the same name was created meanwhile, the tags are for it
+        expired = [path for _, path in expired if not os.path.lexists(path)]
+        if not expired:
+            return
+        with self.file_states.batch():
+            for path in expired:
+                self.file_states.remove_tree(path)
+        self.tags_changed.emit()
+
+    def has_tags(self, path):
+        return path in self.file_states or bool(self.file_states.tagged_in(path)) or \
+            bool(self.file_states.dirs_under(path))
+
+
+def scan(directory):
+    """Inode of every entry of a directory, or None if it can't be read"""
+    try:
+        with os.scandir(directory) as it:
+            return {entry.name: entry.inode() for entry in it}
+    except OSError:
+        return None
@@ -0,0 +1,104 @@
+import errno
+import os
+
+from app.src.tag_store import MAX_TAGS, mask_tags, tag_mask
+
+"""
+Tags kept in an extended attribute of every file, so they go with the file when other programs move or copy it.
+
+The attribute has the ids of the tags separated by commas, like "1,3". Only Linux has extended attributes in the os
+module, and not every filesystem supports them: then the functions say so and the tags stay only in the tag store.
+"""
+
+XATTR_NAME = "user.color_tags"
+SUPPORTED = hasattr(os, "getxattr")
+UNSUPPORTED_ERRORS = (errno.ENOTSUP, errno.EOPNOTSUPP)
+
+
+def encode(mask):
+    return ",".join(str(tag) for tag in mask_tags(mask)).encode("ascii")
+
+
+def decode(value):
+    """Mask of the value of the attribute. Anything that isn't the id of a tag is ignored"""
+    return tag_mask(int(v) for v in value.split(b",") if v.strip().isdigit() and int(v) < MAX_TAGS)
+
+
+def known_mask(color_tags):
+    """Mask of all the tags of the store. The ids that other stores wrote but this one doesn't have are dropped"""
+    return tag_mask(v[3] for v in color_tags)
+
+
+def read_directory(directory):
+    """Tags of the items of a directory, with one system call per item. Symbolic links don't have tags
+
+    :return: ({name: mask} of the items with the attribute, set of all the names), or None if the filesystem doesn't
+    support extended attributes or the directory can't be read
+    """
+    if not SUPPORTED:
+        return None
+    masks = {}
+    names = set()
+    try:
+        with os.scandir(directory) as it:
+            for entry in it:
+                names.add(entry.name)
+                if entry.is_symlink():
+                    continue
+                try:
+                    masks[entry.name] = decode(os.getxattr(entry.path, XATTR_NAME))
+                except OSError as e:
+                    if e.errno in UNSUPPORTED_ERRORS:
+                        return None
+                    # ENODATA, or the item is gone or can't be read
+    except OSError:
+        return None
+    return masks, names
+
+
+def write_mask(path, mask):
+    """Set the attribute of a path, or remove it if the mask is empty
+
+    :return: Whether the filesystem has the attribute now. False if it doesn't support them, if the path doesn't exist
+    or it can't be written
+    """
+    if not SUPPORTED:
+        return False
+    try:
+        if mask:
+            os.setxattr(path, XATTR_NAME, encode(mask), follow_symlinks=False)
+        else:
+            os.removexattr(path, XATTR_NAME, follow_symlinks=False)
+    except OSError as e:
+        return not mask and e.errno == errno.ENODATA
+    return True
+
+
+def export_xattrs(store, root=None):
+    """Write the tags of the store to the attributes of the files, of all the store or of root and what's under it
+
+    :return: (written, failed) number of paths
+    """
+    written = failed = 0
+    items = store.tree_items(root) if root is not None else ((path, store.get_mask(path)) for path in store)
+    for path, mask in items:
+        if write_mask(path, mask):
+            written += 1
+        else:
+            failed += 1
+    return written, failed
+
+
+def import_xattrs(store, root):
+    """Set in the store the tags of the attributes of root and of everything under it, in a single journal write.
+    Items without the attribute keep the tags they have in the store
+
+    :return: Number of paths whose tags changed
+    """
+    known = known_mask(store.color_tags)
+    masks = {}
+    for directory, dirs, files in os.walk(root):
+        result = read_directory(directory)
+        if result is not None:
+            masks.update((os.path.join(directory, name), mask & known) for name, mask in result[0].items())
+    return len(store.set_masks(masks))
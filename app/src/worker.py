@@ -0,0 +1,27 @@
+from PyQt5.QtCore import QObject, QRunnable, pyqtSignal
+
+
+class WorkerSignals(QObject):
+    """Signals of a Worker. They are emitted from the worker thread and received in the thread of the GUI"""
+    progress = pyqtSignal(object)
+    finished = pyqtSignal(object)
+
+
+class Worker(QRunnable):
+    """Job that runs work() in a thread of a QThreadPool and then emits `finished` with itself.
+
+    The pool doesn't delete it, so whoever started it can read its results when it's finished. Partial results can be
+    sent with `progress` while it runs.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.setAutoDelete(False)
+        self.signals = WorkerSignals()
+
+    def run(self):
+        self.work()
+        self.signals.finished.emit(self)
+
+    def work(self):
+        raise NotImplementedError
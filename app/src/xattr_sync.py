@@ -0,0 +1,150 @@
+import os
+from collections import OrderedDict
+
+from PyQt5.QtCore import QObject, QThreadPool, pyqtSignal
+
+from app.src.tag_store import in_tree
+from app.src.tag_xattr import known_mask, read_directory, write_mask
+from app.src.worker import Worker
+
+MAX_CACHED_DIRS = 64
+
+
+class ReadJob(Worker):
+    """Read the attributes of the items of a directory in a worker thread"""
+
+    def __init__(self, directory):
+        super().__init__()
+        self.directory = directory
+        self.result = None
+        # Names whose tags changed in the store while the job ran, or None if all of them were replaced. What the job
+        # read of them is older than the store
+        self.changed = set()
+
+    def work(self):
+        self.result = read_directory(self.directory)
+
+
+class XattrSync(QObject):
+    """Keeps the tags in the extended attributes of the files as well as in the tag store.
+
+    Every change of the store is written to the attribute of its path. When a directory is shown, the attributes of
+    its items are read in a worker thread and, where they differ from the store, they win: a file that another
+    program moved or copied there brings its tags, unless they changed in the store while the directory was read.
+    Items without the attribute, or with only ids of tags this store doesn't have, get the tags of the store. The
+    directories that were read are kept in a cache, so going back to them doesn't read anything, and painting always
+    uses the store. The files of a moved or copied tree carry their attributes, so nothing is written for them and
+    the directories of the tree that were read are read again. On filesystems without extended attributes the store
+    is all there is.
+    """
+    tags_changed = pyqtSignal()
+
+    def __init__(self, file_states, max_dirs=MAX_CACHED_DIRS, parent=None):
+        super().__init__(parent)
+        self.file_states = file_states
+        self.max_dirs = max_dirs
+
+        self.cache = OrderedDict()  # Directory -> {name: mask} of its attributes, or None if they aren't supported
+        self.applying = False  # Whether the store is being changed from the attributes
+        self.pool = QThreadPool(self)
+        self.pool.setMaxThreadCount(1)
+        self.jobs = {}  # Directory -> ReadJob
+        self.file_states.listeners.append(self.path_changed)
+        self.file_states.tree_listeners.append(self.tree_changed)
+
+    def read(self, directory):
+        """Read the attributes of a directory that is going to be shown, unless they're in the cache"""
+        if directory in self.cache:
+            self.cache.move_to_end(directory)
+            return
+        if directory in self.jobs:
+            return
+        job = ReadJob(directory)
+        job.signals.finished.connect(self.directory_read)
+        self.jobs[directory] = job
+        self.pool.start(job)
+
+    def directory_changed(self, directory):
+        """Read again a directory whose items changed, if it was read before"""
+        if self.cache.pop(directory, False) is not False:
+            self.read(directory)
+
+    def stop(self):
+        self.pool.waitForDone()
+        self.file_states.listeners.remove(self.path_changed)
+        self.file_states.tree_listeners.remove(self.tree_changed)
+
+    def directory_read(self, job):
+        del self.jobs[job.directory]
+        directory = job.directory
+        if job.changed is None:
+            return  # It's read again when it's shown
+        if job.result is None:
+            masks = None
+        else:
+            known = known_mask(self.file_states.color_tags)
+            tagged = self.file_states.tagged_in(directory)
+            masks = {name: mask & known for name, mask in job.result[0].items() if mask & known}
+            # The tags that changed meanwhile were already written to the attributes
+            for name in job.changed:
+                if name in tagged:
+                    masks[name] = tagged.get(name)
+                else:
+                    masks.pop(name, None)
+        self.cache[directory] = masks
+        while len(self.cache) > self.max_dirs:
+            self.cache.popitem(last=False)
+        if masks is None:
+            return
+
+        names = job.result[1]
+        changes = {}
+        for name, mask in masks.items():
+            if tagged.get(name, 0) != mask:
+                changes[os.path.join(directory, name)] = mask
+        if changes:
+            self.applying = True
+            try:
+                self.file_states.set_masks(changes)
+            finally:
+                self.applying = False
+            self.tags_changed.emit()
+
+        # The items that were tagged before the attributes were used get them now
+        for name, mask in list(tagged.items()):
+            if name in names and name not in masks:
+                write_mask(os.path.join(directory, name), mask)
+                masks[name] = mask
+
+    def path_changed(self, path, mask):
+        if path is None:
+            self.cache.clear()
+            for job in self.jobs.values():
+                job.changed = None
+            return
+        if self.applying:
+            return
+
+        directory, name = os.path.split(path)
+        job = self.jobs.get(directory)
+        if job is not None and job.changed is not None:
+            job.changed.add(name)
+        masks = self.cache.get(directory, {})
+        if masks is None:
+            return  # The filesystem doesn't support them
+        if write_mask(path, mask) and directory in self.cache:
+            if mask:
+                masks[name] = mask
+            else:
+                masks.pop(name, None)
+
+    def tree_changed(self, op, source, target):
+        roots = (source, target) if op == "move" else (target,)
+        for directory in list(self.cache) + list(self.jobs):
+            if any(directory == os.path.dirname(root) or in_tree(directory, root) for root in roots):
+                if directory in self.jobs:
+                    self.jobs[directory].changed = None
+                else:
+                    del self.cache[directory]
+                    if os.path.isdir(directory):
+                        self.read(directory)
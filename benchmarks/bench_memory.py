@@ -0,0 +1,76 @@
+#!/usr/bin/python3
+
+"""
+Memory used by the file states: a plain dictionary of full paths to tag ids, the way they were kept before, against
+TagStore. The paths are built the way a real tree is, many files under a few thousand directories.
+
+    python3 benchmarks/bench_memory.py --paths 1000000
+"""
+
+import argparse
+import gc
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.src.tag_store import TagStore
+
+
+def synthetic_paths(count, per_directory):
+    for i in range(count):
+        d = i // per_directory
+        yield f"/home/user/projects/project-{d % 97}/src/module-{d}/file-{i}.py", i % 3
+
+
+def measure(build):
+    gc.collect()
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = build()
+    elapsed = time.perf_counter() - start
+    gc.collect()
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, size, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--paths", type=int, default=1000000, help="Number of tagged paths")
+    parser.add_argument("--per-directory", type=int, default=50, help="Tagged paths in every directory")
+    args = parser.parse_args()
+
+    def build_dict():
+        return {path: tag for path, tag in synthetic_paths(args.paths, args.per_directory)}
+
+    with tempfile.TemporaryDirectory() as tmp:
+        def build_store():
+            store = TagStore(os.path.join(tmp, "meta.json"))
+            for path, tag in synthetic_paths(args.paths, args.per_directory):
+                store._set(path, tag)  # Only the memory is measured here, the journal isn't written
+            return store
+
+        plain, dict_size, dict_time = measure(build_dict)
+        del plain
+        store, store_size, store_time = measure(build_store)
+
+        # Lookups the way ColorDelegate.paint and update_index_value do them
+        paths = [path for path, _ in synthetic_paths(min(args.paths, 100000), args.per_directory)]
+        start = time.perf_counter()
+        for path in paths:
+            store.get(path)
+        lookup = (time.perf_counter() - start) / len(paths)
+        store.close()
+
+    print(f"paths: {args.paths}, {args.per_directory} per directory")
+    print(f"dict:     {dict_size / 2 ** 20:8.1f} MiB, built in {dict_time:.2f} s")
+    print(f"TagStore: {store_size / 2 ** 20:8.1f} MiB, built in {store_time:.2f} s, "
+          f"{lookup * 1e6:.2f} us per lookup")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+#!/usr/bin/python3
+
+"""
+Microbenchmark of ColorDelegate.paint.
+
+Paints every row of a synthetic directory into an offscreen image, once with the row cache cold (it's cleared before
+every row, which is what every paint cost before the cache) and once with it warm, and prints the cost per row.
+
+Run it from the root of the repository:
+
+    QT_QPA_PLATFORM=offscreen python3 benchmarks/bench_paint.py --entries 5000
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+from common import wait_for_directory
+
+from PyQt5.QtCore import QRect
+from PyQt5.QtGui import QImage, QPainter
+from PyQt5.QtWidgets import QApplication, QStyleOptionViewItem
+
+from app.src.file_explorer import FileExplorerApp
+
+
+def paint_rows(window, painter, rows, clear_cache):
+    delegate = window.delegate
+    model = window.listView.model()
+    root = window.listView.rootIndex()
+    option = QStyleOptionViewItem()
+    indexes = [model.index(row, 0, root) for row in range(rows)]
+
+    start = time.perf_counter()
+    for row, index in enumerate(indexes):
+        if clear_cache:
+            delegate.invalidate()
+        option.rect = QRect(0, (row % 40) * 20, 400, 20)
+        delegate.paint(painter, option, index)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--entries", type=int, default=5000, help="Number of files in the directory")
+    parser.add_argument("--tagged", type=float, default=0.5, help="Fraction of the files that are tagged")
+    parser.add_argument("--repeat", type=int, default=5, help="Number of warm repaints")
+    args = parser.parse_args()
+
+    app = QApplication(sys.argv)
+    with tempfile.TemporaryDirectory() as tmp:
+        directory = os.path.join(tmp, "files")
+        os.mkdir(directory)
+        for i in range(args.entries):
+            open(os.path.join(directory, f"file-{i:07d}.txt"), "w").close()
+
+        window = FileExplorerApp(os.path.join(tmp, "meta.json"))
+        window.tag_collector.stop()
+        with window.file_states.batch():
+            for i in range(int(args.entries * args.tagged)):
+                window.file_states[os.path.join(directory, f"file-{i:07d}.txt")] = i % 3
+        window.change_directory(directory)
+        wait_for_directory(app, window, args.entries)
+
+        image = QImage(400, 800, QImage.Format_ARGB32)
+        painter = QPainter(image)
+        cold = paint_rows(window, painter, args.entries, True)
+        paint_rows(window, painter, args.entries, False)
+        warm = min(paint_rows(window, painter, args.entries, False) for _ in range(args.repeat))
+        painter.end()
+
+        print(f"rows: {args.entries}, tagged: {int(args.entries * args.tagged)}")
+        print(f"cold cache: {cold / args.entries * 1e6:.2f} us/row")
+        print(f"warm cache: {warm / args.entries * 1e6:.2f} us/row")
+
+        window.file_states.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,59 @@
+"""
+Helpers shared by the benchmarks: synthetic directories and metadata files, and waiting for QFileSystemModel
+"""
+
+import json
+import os
+import sys
+import time
+
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.src.tag_store import DEFAULT_COLOR_TAGS
+
+
+def make_directory(path, entries):
+    """Create a directory with entries empty files. Every tenth entry is a subdirectory"""
+    os.makedirs(path, exist_ok=True)
+    names = []
+    for i in range(entries):
+        name = f"entry-{i:07d}" if i % 10 == 0 else f"entry-{i:07d}.txt"
+        full_path = os.path.join(path, name)
+        if i % 10 == 0:
+            os.mkdir(full_path)
+        else:
+            os.close(os.open(full_path, os.O_CREAT | os.O_WRONLY, 0o644))
+        names.append(name)
+    return names
+
+
+def make_metadata(meta_file, directory, names, tagged_paths, tagged_fraction=0.75):
+    """Write a metadata file with tagged_paths tagged paths.
+
+    A fraction of the names of the directory are tagged, and the rest of the paths are spread in synthetic
+    directories that don't exist, the way old tags of a big database are.
+    """
+    tag_ids = [v[3] for v in DEFAULT_COLOR_TAGS]
+    file_states = {}
+    for i, name in enumerate(names[:int(len(names) * tagged_fraction)]):
+        file_states[os.path.join(directory, name)] = tag_ids[i % len(tag_ids)]
+
+    i = 0
+    while len(file_states) < tagged_paths:
+        file_states[f"/synthetic/project-{i % 997}/dir-{i % 89}/file-{i}.dat"] = tag_ids[i % len(tag_ids)]
+        i += 1
+
+    with open(meta_file, "w") as f:
+        json.dump({"file-states": file_states, "color-tags": DEFAULT_COLOR_TAGS}, f)
+    return file_states
+
+
+def wait_for_directory(app, window, entries, timeout=600):
+    """Process events until QFileSystemModel has all the entries of the shown directory"""
+    deadline = time.perf_counter() + timeout
+    while time.perf_counter() < deadline:
+        app.processEvents()
+        if window.file_model.rowCount(window.file_model.index(window.current_path["path"])) >= entries:
+            break
+    app.processEvents()
@@ -0,0 +1,169 @@
+#!/usr/bin/python3
+
+"""
+Benchmark suite of the explorer at realistic scale.
+
+For every size it creates a synthetic directory with that many entries and a metadata file with that many tagged
+paths, and times:
+
+ - convert: loading the JSON metadata file and writing the binary snapshot
+ - load: FileExplorerApp.__init__, which opens the snapshot, and index: parsing the rest of it after the window shows
+ - populate: QFileSystemModel listing the directory
+ - filter: filter_tag with a tag and back to all the items
+ - paint: a full viewport repaint through ColorDelegate.paint, with the row cache cold and warm
+ - icon_hit_rate: fraction of the icons the CachedIconProvider had in its cache while populating and painting
+ - save: closeEvent, and a forced compaction of the metadata file
+ - edit_tags: EditTagsDialog reorder (move down and up) and delete of a tag
+ - move_tree, copy_tree: moving the tags of the whole directory to another path, and copying them back
+
+The results are written as JSON so they can be compared between commits:
+
+    python3 benchmarks/run_benchmarks.py --sizes 10000,100000 --output bench.json
+    python3 benchmarks/run_benchmarks.py --sizes 1000000 --output bench-1m.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+from common import make_directory, make_metadata, wait_for_directory
+
+from PyQt5.QtCore import QItemSelectionModel, QT_VERSION_STR
+from PyQt5.QtWidgets import QApplication
+
+from app.src.dialogs import EditTagsDialog
+from app.src.file_explorer import FileExplorerApp
+from app.src.tag_store import TagStore
+
+
+class Timer:
+    def __init__(self, results, name):
+        self.results = results
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        self.results[self.name] = time.perf_counter() - self.start
+
+
+def select_tag(dialog, row):
+    index = dialog.model.index(row, 0)
+    dialog.listView.selectionModel().select(index, QItemSelectionModel.ClearAndSelect)
+
+
+def run_size(app, tmp, size, results):
+    directory = os.path.join(tmp, f"dir-{size}")
+    meta_file = os.path.join(tmp, f"meta-{size}.json")
+
+    with Timer(results, "setup_tree"):
+        names = make_directory(directory, size)
+        make_metadata(meta_file, directory, names, size)
+    results["meta_file_bytes"] = os.path.getsize(meta_file)
+
+    with Timer(results, "convert"):
+        TagStore(meta_file).close()
+    store = TagStore(meta_file)
+    results["snapshot_bytes"] = os.path.getsize(store.snapshot_file)
+    store.close()
+
+    with Timer(results, "load"):
+        window = FileExplorerApp(meta_file)
+    # The synthetic paths don't exist, the collector would be removing them during the measures
+    window.tag_collector.stop()
+    with Timer(results, "index"):
+        window.file_states.ensure_index()
+    window.resize(800, 600)
+    window.show()
+
+    with Timer(results, "populate"):
+        window.change_directory(directory)
+        wait_for_directory(app, window, size)
+
+    with Timer(results, "filter"):
+        window.filter_tag(1)
+        app.processEvents()
+    with Timer(results, "filter_off"):
+        window.filter_tag(1)
+        app.processEvents()
+
+    viewport = window.listView.viewport()
+    with Timer(results, "paint_cold"):
+        window.delegate.invalidate()
+        viewport.repaint()
+    with Timer(results, "paint_warm"):
+        viewport.repaint()
+    results["icon_hit_rate"] = window.icon_provider.hit_rate()
+
+    dialog = EditTagsDialog(window.color_tags, window.file_states, window)
+    select_tag(dialog, 0)
+    with Timer(results, "reorder"):
+        dialog.move_down()
+        select_tag(dialog, 1)
+        dialog.move_up()
+    select_tag(dialog, 0)
+    with Timer(results, "delete_tag"):
+        dialog.delete_tag(0)
+    dialog.close()
+
+    moved = directory + "-moved"
+    with Timer(results, "move_tree"):
+        window.file_states.move_tree(directory, moved)
+    with Timer(results, "copy_tree"):
+        window.file_states.copy_tree(moved, directory)
+
+    with Timer(results, "save_close"):
+        window.close()
+    store = window.file_states
+    with Timer(results, "save_compact"):
+        store.compact()
+    store.close()
+    results["snapshot_bytes_after"] = os.path.getsize(store.snapshot_file)
+
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        return None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--sizes", default="10000,100000",
+                        help="Comma separated numbers of entries and tagged paths (default: %(default)s)")
+    parser.add_argument("--output", help="File where the JSON results are written, they are printed if it's not set")
+    args = parser.parse_args()
+
+    app = QApplication(sys.argv)
+    report = {"commit": git_commit(),
+              "python": platform.python_version(),
+              "qt": QT_VERSION_STR,
+              "platform": platform.platform(),
+              "results": {}}
+
+    for size in [int(v) for v in args.sizes.split(",")]:
+        results = {}
+        with tempfile.TemporaryDirectory() as tmp:
+            run_size(app, tmp, size, results)
+        report["results"][str(size)] = results
+        print(f"{size}: " + ", ".join(f"{k}={v:.4f}" if isinstance(v, float) else f"{k}={v}"
+                                      for k, v in results.items()), file=sys.stderr)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+    else:
+        print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,269 @@
+#!/usr/bin/python3
+
+"""
+Several processes changing the same metadata file at once, the way several explorer windows and scripts do. Every
+process tags its own paths, one at a time and in batches, removes some of them and moves a directory, with a low
+compaction threshold so the journal is folded into the snapshot many times while the others write. When all of them
+are done, every process reads the changes of the others from the journal, and the state it ends with, and the state of
+a store opened afterwards, must have every change of every process.
+
+Before that, two stores check that a tag removed by one of them after the other compacted isn't read back from the
+old snapshot, with the index of the first one parsed and without it, a store that reads the changes of another one
+must do it without parsing its index, and a store checks that the searches from the filesystem root see every path
+once.
+
+    python3 benchmarks/stress_concurrent.py --processes 8 --changes 2000
+"""
+
+import argparse
+import multiprocessing
+import os
+import queue
+import sys
+import tempfile
+import time
+import traceback
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from app.src.tag_store import TagStore
+
+BATCH_SIZE = 20
+
+
+def worker_paths(worker, changes):
+    """(path, mask) of the changes of a worker, in order"""
+    root = f"/stress/worker-{worker}"
+    for i in range(changes):
+        yield f"{root}/dir-{i % 16}/file-{i}", 1 << (1 + (worker + i) % 3)
+
+
+def expected_state(worker, changes):
+    """{path: mask} that a worker leaves: every tenth path is removed again, and dir-0 is moved to moved-0"""
+    root = f"/stress/worker-{worker}"
+    state = {}
+    for i, (path, mask) in enumerate(worker_paths(worker, changes)):
+        if i % 10 != 5:
+            state[path] = mask
+    moved = root + "/dir-0"
+    return {root + "/moved-0" + path[len(moved):] if path.startswith(moved + "/") else path: mask
+            for path, mask in state.items()}
+
+
+def masks(store):
+    return {path: store.get_mask(path) for path in store}
+
+
+def run_worker(meta_file, worker, changes, compact_threshold, barrier, results):
+    try:
+        results.put(write_and_sync(meta_file, worker, changes, compact_threshold, barrier))
+    except Exception:
+        # The other processes don't wait for this one
+        barrier.abort()
+        results.put((worker, None, traceback.format_exc()))
+
+
+def write_and_sync(meta_file, worker, changes, compact_threshold, barrier):
+    store = TagStore(meta_file, compact_threshold=compact_threshold)
+    paths = list(worker_paths(worker, changes))
+    start = time.perf_counter()
+    i = 0
+    while i < len(paths):
+        # Half of the changes are single writes and the rest are batches
+        if (i // BATCH_SIZE) % 2:
+            with store.batch():
+                for path, mask in paths[i:i + BATCH_SIZE]:
+                    store.set_mask(path, mask)
+            i += BATCH_SIZE
+        else:
+            store.set_mask(*paths[i])
+            i += 1
+        for path, _ in paths[max(0, i - BATCH_SIZE):i]:
+            if int(path.rsplit("-", 1)[1]) % 10 == 5 and path in store:
+                del store[path]
+        if i % 100 == 0:
+            store.sync()
+    store.move_tree(f"/stress/worker-{worker}/dir-0", f"/stress/worker-{worker}/moved-0")
+    elapsed = time.perf_counter() - start
+
+    # When every process is done, this one reads what the others wrote since its last change
+    barrier.wait()
+    store.sync()
+    view = masks(store)
+    store.close()
+    return worker, elapsed, view
+
+
+def collect(processes, results, barrier):
+    """(worker, elapsed, state) sent by every process. A process killed by a signal doesn't send it, then the others
+    stop waiting for it at the barrier
+    """
+    views = {}
+    while len(views) < len(processes):
+        try:
+            worker, elapsed, view = results.get(timeout=1)
+            views[worker] = (worker, elapsed, view)
+        except queue.Empty:
+            for worker, process in enumerate(processes):
+                if worker not in views and process.exitcode not in (None, 0):
+                    views[worker] = (worker, None, f"exit code {process.exitcode}")
+                    barrier.abort()
+    return list(views.values())
+
+
+def check_compact_then_delete(tmp, indexed):
+    """Remove a tag with a store after another one compacted and decoded its directory
+
+    :return: Error message, or None if the tag is removed in both stores and on disk
+    """
+    meta_file = os.path.join(tmp, f"meta-{indexed}.json")
+    store = TagStore(meta_file)
+    store["/d/f"] = 1
+    store["/e/g"] = 2
+    store.compact()
+    store.close()
+
+    first, second = TagStore(meta_file), TagStore(meta_file)
+    if indexed:
+        first.ensure_index()
+        second.compact()
+        first.sync()
+    first.get_mask("/d/f")
+    del second["/d/f"]
+    first.sync()
+    if first.get_mask("/d/f") is not None:
+        return "the removed tag is still in the store that synced"
+    first.compact()
+    first.close()
+    second.close()
+    if TagStore(meta_file).get_mask("/d/f") is not None:
+        return "the removed tag is back on disk"
+    return None
+
+
+def check_foreign_lazily(tmp):
+    """Read the changes and the tree moves of another store, from the journal and when opening the file, with a store
+    whose index isn't parsed
+
+    :return: Error message, or None if the store has the changes and its index is still not parsed
+    """
+    meta_file = os.path.join(tmp, "meta-lazy.json")
+    store = TagStore(meta_file)
+    for i in range(100):
+        store.set_mask(f"/d/e-{i % 10}/f-{i}", 2)
+    store.compact()
+    store.close()
+
+    first, second = TagStore(meta_file), TagStore(meta_file)
+    first.get_mask("/d/e-0/f-0")
+    second.set_mask("/d/e-0/f-0", 4)
+    del second["/d/e-1/f-1"]
+    second.move_tree("/d/e-2", "/moved")
+    second.copy_tree("/d/e-3", "/copied")
+    first.sync()
+    third = TagStore(meta_file)
+    try:
+        # The index is parsed by the operations over the whole store, so it's checked before comparing them
+        if first._indexed or third._indexed:
+            return "the index was parsed to apply the changes of the other store"
+        if masks(first) != masks(second) or masks(third) != masks(second):
+            return "the changes of the other store are missing"
+        return None
+    finally:
+        for store in (first, second, third):
+            store.close()
+
+
+def check_root(tmp):
+    """Search and remove the tags under the filesystem root, whose directory is the prefix of all the others
+
+    :return: Error message, or None if every path is found once and removed
+    """
+    store = TagStore(os.path.join(tmp, "meta-root.json"))
+    for path in ("/f", "/d/f", "/d/e/f"):
+        store.set_mask(path, 2)
+    try:
+        if store.dirs_under("/") != ["/d", "/d/e"]:
+            return f"directories under the root: {store.dirs_under('/')}"
+        found = sorted(store.find_under("/", 1))
+        if found != ["/d/e/f", "/d/f", "/f"]:
+            return f"paths found under the root: {found}"
+        store.remove_tree("/")
+        if len(store):
+            return f"{len(store)} paths left after removing the root"
+        return None
+    finally:
+        store.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--processes", type=int, default=8, help="Number of processes writing at once")
+    parser.add_argument("--changes", type=int, default=2000, help="Paths tagged by every process")
+    parser.add_argument("--compact-threshold", type=int, default=500, help="Journal records before a compaction")
+    args = parser.parse_args()
+
+    expected = {}
+    for worker in range(args.processes):
+        expected.update(expected_state(worker, args.changes))
+
+    failed = False
+    with tempfile.TemporaryDirectory() as tmp:
+        for indexed in (True, False):
+            try:
+                error = check_compact_then_delete(tmp, indexed)
+            except Exception:
+                error = traceback.format_exc()
+            if error is not None:
+                failed = True
+                print(f"compact then delete{'' if indexed else ' without index'}: {error}")
+        for name, check in (("changes of another store", check_foreign_lazily), ("filesystem root", check_root)):
+            try:
+                error = check(tmp)
+            except Exception:
+                error = traceback.format_exc()
+            if error is not None:
+                failed = True
+                print(f"{name}: {error}")
+
+        meta_file = os.path.join(tmp, "meta.json")
+        barrier = multiprocessing.Barrier(args.processes)
+        results = multiprocessing.Queue()
+        processes = [multiprocessing.Process(target=run_worker, args=(meta_file, worker, args.changes,
+                                                                       args.compact_threshold, barrier, results))
+                     for worker in range(args.processes)]
+        start = time.perf_counter()
+        for process in processes:
+            process.start()
+        views = collect(processes, results, barrier)
+        for process in processes:
+            process.join()
+        elapsed = time.perf_counter() - start
+
+        store = TagStore(meta_file)
+        final = masks(store)
+        store.close()
+
+    for worker, seconds, view in sorted(views):
+        if seconds is None:
+            failed = True
+            print(f"process {worker} failed:\n{view}")
+        elif view != expected:
+            failed = True
+            print(f"process {worker}: {len(set(expected.items()) - set(view.items()))} changes missing, "
+                  f"{len(set(view.items()) - set(expected.items()))} unexpected")
+    missing = set(expected.items()) - set(final.items())
+    unexpected = set(final.items()) - set(expected.items())
+    if missing or unexpected:
+        failed = True
+        print(f"reopened store: {len(missing)} changes missing, {len(unexpected)} unexpected")
+
+    total = args.processes * (args.changes + args.changes // 10 + 1)
+    print(f"processes: {args.processes}, changes: {total}, {total / elapsed:.0f} changes/s, "
+          f"slowest process {max(v[1] or 0 for v in views):.2f} s")
+    print("FAILED" if failed else f"OK: all the {len(expected)} tagged paths are in every process and on disk")
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == "__main__":
+    main()